@@ -1,144 +1,163 @@
-"""Code for updating the root README.md with the last date of the update."""
+"""Code for updating the root README.md (or any other page with the same tags) with the last date of the update.
 
+The tagged regions are found with one precompiled pattern in a single pass over the whole file:
+  <!--date_long_start-->...<!--date_long_end-->: Everything between the tags is replaced with the date, e.g.
+      "Saturday, December 23, 2023".
+  <!--contains_short_date_start-->...<!--contains_short_date_end-->: The YYYY.MM.DD date between the tags is replaced.
+The start and end tags may be on different lines. <img> sources can be re-pointed in the same pass (see render_text).
+"""
+
+import argparse
 import datetime
+import difflib
 import os
 import re
+import stat
 
+import atomic_file
 
-def substitute_date_in_readme():
-    """Put the latest date (datestr as a YYYY.MM.DD format) into the main README.md file.
+readme_fname_default = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "README.md"))
+date_fname_default = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "images", "most_recent_date.txt"))
 
-    The date string is from the file /images/most_recent_date.txt.
-    This shoudl be run at the end of creating a new post in anttoday_social.py.
+date_long_start_tag = "<!--date_long_start-->"
+date_long_end_tag = "<!--date_long_end-->"
+date_short_start_tag = "<!--contains_short_date_start-->"
+date_short_end_tag = "<!--contains_short_date_end-->"
+
+
+def _region_pattern(name: str, start_tag: str, end_tag: str) -> str:
+    # The region body can span lines, but can't run into another start tag of its own kind. That way a start tag with
+    # a missing end tag doesn't swallow everything up to the next region's end tag.
+    return r"(?P<{0}_start>{1})(?P<{0}_body>(?:(?!{1}).)*?)(?P<{0}_end>{2})".format(
+        name, re.escape(start_tag), re.escape(end_tag))
+
+
+# One pattern for every region we might substitute, so each file is scanned once.
+readme_regex = re.compile("|".join([_region_pattern("long", date_long_start_tag, date_long_end_tag),
+                                    _region_pattern("short", date_short_start_tag, date_short_end_tag),
+                                    r'(?P<img_start><img\s[^>]*?src=")(?P<img_src>[^"]*)(?P<img_end>")']),
+                          re.DOTALL)
+img_src_regex = re.compile(r'(<img\s[^>]*?src=")([^"]*)(")')
+short_date_regex = re.compile(r"\d{4}\.\d{2}\.\d{2}")
+datestr_regex = re.compile(r"\A\d{4}\.\d{2}\.\d{2}\Z")
 
-    Returns True if the README.md was changed at all. False otherwise.
-    """
 
-    # Fetch the latest date string from "most_recent_date.txt"
-    date_fname = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "images", "most_recent_date.txt"))
+def read_date_str(date_fname: str = date_fname_default) -> str:
+    """Read the YYYY.MM.DD date from /images/most_recent_date.txt."""
     assert os.path.exists(date_fname)
     date_str = open(date_fname, 'r').read().strip()
-    assert re.search(r"\A\d{4}\.\d{2}\.\d{2}\Z", date_str) is not None
+    assert datestr_regex.search(date_str) is not None
+    return date_str
 
+
+def _new_img_src(src: str, image_srcs: dict) -> str:
+    """Return the new src for an image if its file name starts with one of the prefixes in image_srcs, else the old."""
+    src_fname = src.rsplit("/", 1)[-1]
+    for prefix, new_src in image_srcs.items():
+        if src_fname.startswith(prefix):
+            return new_src
+    return src
+
+
+def render_text(text: str,
+                date_str: str,
+                image_srcs: dict = None) -> str:
+    """Substitute the date (and, optionally, image sources) into all the tagged regions of a page's text.
+
+    :param text: The contents of the page.
+    :param date_str: The date, in YYYY.MM.DD format.
+    :param image_srcs: {file name prefix: new src}, e.g. {"R0_daily_": "./images/R0_daily_2024.04.24.png"}. Each <img>
+        whose src file name starts with that prefix gets the new src. If None, image sources are left alone.
+    :return: The new text.
+    """
+    assert datestr_regex.search(date_str) is not None
     # Create a pretty version of the date string, e.g. "Saturday, December 23, 2023"
     date_str_pretty = datetime.datetime.strptime(date_str, "%Y.%m.%d").strftime("%A, %B %-d, %Y")
 
-    readme_fname = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "README.md"))
-    # Make sure the README file is actually there.
-    assert os.path.exists(readme_fname)
-
-    # Read the README.md in lines:
-    lines = open(readme_fname, 'r').readlines()
-    lines_out = [""] * len(lines)
-
-    date_long_start_comment = r'<!--date_long_start-->'
-    date_long_end_comment = r'<!--date_long_end-->'
-
-    date_short_start_comment = r'<!--contains_short_date_start-->'
-    date_short_end_comment = r'<!--contains_short_date_end-->'
-
-    for i, line in enumerate(lines):
-        # Look for both the start and end date tags.
-        date_long_start_match = re.search(date_long_start_comment, line)
-        if date_long_start_match is not None:
-            date_long_end_match = re.search(date_long_end_comment, line)
-            # If that date_start string is in the line, the date_end string should be too.
-            if date_long_end_match is None:
-                print("WARNING: String '{0}' found on line {1} of README.md without '{2}'. Skipping.".format(
-                    date_long_start_comment,
-                    i + 1,
-                    date_long_end_comment
-                ))
+    def substitute(m: re.Match) -> str:
+        if m.group("long_start") is not None:
+            return m.group("long_start") + date_str_pretty + m.group("long_end")
+
+        if m.group("short_start") is not None:
+            body = m.group("short_body")
+            if image_srcs:
+                body = img_src_regex.sub(lambda im: im.group(1) + _new_img_src(im.group(2), image_srcs) + im.group(3),
+                                         body)
+            if short_date_regex.search(body) is None:
+                print("WARNING: No YYYY.MM.DD date string between the tags in:\n{0}".format(m.group(0)))
             else:
-                # Sanity check to make soure our logic checks out. Both these should be valid matches here.
-                assert date_long_start_match is not None and date_long_end_match is not None
-                # If we've gotten here, we have a matching line.
-                # print("Line", i + 1, date_start_match, date_end_match)
-                # print(line[date_start_match.span()[1] : date_end_match.span()[0]])
-
-                # Get the start text on the line (before the date):
-                line_start = line[:date_long_start_match.span()[1]]
-                line_end = line[date_long_end_match.span()[0]:]
-
-                # Create the new line with the new date string in there.
-                line = line_start + date_str_pretty + line_end
-
-        # Above we substituted the "pretty date" string if it existed. Now look for the other "short date" string.
-        # It'll be between the date_short_start_comment and date_short_end_comment, and in the format YYYY.MM.DD
-        # First, find the date_short_start_comment.
-        date_short_start_match = re.search(date_short_start_comment, line)
-        if date_short_start_match is not None:
-            date_short_end_match = re.search(date_short_end_comment, line)
-
-            # If that date_start string is in the line, the date_end string should be too.
-            if date_short_end_match is None:
-                print("WARNING: String '{0}' found on line {1} of README.md without '{2}':\n{3}\nSkipping.".format(
-                    date_short_start_comment,
-                    i + 1,
-                    date_short_end_comment,
-                    line.rstrip()
-                ))
-            else:
-                # Cut out the span in which to search for the YYYY.MM.DD.
-                # This is a bit different than above because we're just looking for a subset of the string
-                # between the comments, not the whole string.
-                line_subset = line[date_short_start_match.span()[1]:date_short_end_match.span()[0]]
-                subset_datestr_match = re.search(r"\d{4}\.\d{2}\.\d{2}", line_subset)
-
-                if subset_datestr_match is None:
-                    print("WARNING: Line {0}:\n{1}\n...does not contain a date string in the YYYY.MM.DD format.".format(
-                        i + 1,
-                        lines[i + 1]
-                    ))
-
-                else:
-                    # Sanity check to make soure our logic checks out. All 3 of these should be valid matches here.
-                    assert date_short_start_match is not None \
-                           and date_short_end_match is not None \
-                           and subset_datestr_match is not None
-
-                    # The part before (and including) the date_short_start_comment
-                    line_part_1 = line[:date_short_start_match.span()[1]]
-                    # The part of the middle subset before the YYYY.MM.DD string
-                    line_part_2 = line_subset[:subset_datestr_match.span()[0]]
-                    # The new YYYY.MM.DD string.
-                    line_part_3 = date_str
-                    # The part of the middle subset after the YYYY.MM.DD string
-                    line_part_4 = line_subset[subset_datestr_match.span()[1]:]
-                    # The part after (and including) the date_short_end_comment
-                    line_part_5 = line[date_short_end_match.span()[0]:]
-                    line = line_part_1 + line_part_2 + line_part_3 + line_part_4 + line_part_5
-
-        # Swap the line in the file with the new line we just created.
-        lines_out[i] = line
-
-    print("ORIGINAL LINES:")
-    for oline in lines:
-        print(oline, end="")
-
-    print("\nNEW LINES:")
-    for nline in lines_out:
-        print(nline, end="")
-
-    # If no lines were actually changed, at all, we can just say that and don't bother re-writing the file.
-    numlines_changed = 0
-    for l1, l2 in zip(lines, lines_out):
-        if l1 != l2:
-            numlines_changed += 1
-
-    if numlines_changed == 0:
-        print(os.path.basename(readme_fname), "not modified. No changes made.")
-        return False
-
-    # Output the new lines to the README file.
-    open(readme_fname, 'w').writelines(lines_out)
-    assert os.path.exists(readme_fname)
-
-    print(os.path.basename(readme_fname), "updated with '{0}', {1} lines modified.".format(date_str_pretty,
-                                                                                           numlines_changed))
-
-    return True
+                body = short_date_regex.sub(date_str, body, count=1)
+            return m.group("short_start") + body + m.group("short_end")
+
+        # An <img> outside any tagged region.
+        if image_srcs:
+            return m.group("img_start") + _new_img_src(m.group("img_src"), image_srcs) + m.group("img_end")
+        return m.group(0)
+
+    text_out = readme_regex.sub(substitute, text)
+
+    # Any start tags left over didn't have a matching end tag.
+    for start_tag, end_tag in [(date_long_start_tag, date_long_end_tag), (date_short_start_tag, date_short_end_tag)]:
+        if text.count(start_tag) != text.count(end_tag):
+            print("WARNING: {0} '{1}' tag(s) but {2} '{3}' tag(s). Unmatched tags are skipped.".format(
+                text.count(start_tag), start_tag, text.count(end_tag), end_tag))
+
+    return text_out
+
+
+def _write_atomic(fname: str, text: str):
+    # Keep the original file's permissions (atomic_write otherwise creates files only the owner can read).
+    with atomic_file.atomic_write(fname, file_permissions=stat.S_IMODE(os.stat(fname).st_mode)) as f:
+        f.write(text)
+
+
+def render_files(fnames: list,
+                 date_str: str,
+                 image_srcs: dict = None) -> list:
+    """Render the date (and optionally image sources) into each of several pages, e.g. the README.md and a web page.
+
+    Each file is only re-written (atomically) if its contents changed. A short diff of the changed lines is printed.
+    Returns the list of files that were changed."""
+    changed = []
+    for fname in fnames:
+        # Make sure the file is actually there.
+        assert os.path.exists(fname)
+        text = open(fname, 'r').read()
+        text_out = render_text(text, date_str, image_srcs=image_srcs)
+
+        if text_out == text:
+            print(os.path.basename(fname), "not modified. No changes made.")
+            continue
+
+        diff_lines = [line for line in difflib.unified_diff(text.splitlines(), text_out.splitlines(), lineterm="", n=0)
+                      if line.startswith(("-", "+")) and not line.startswith(("---", "+++"))]
+        print(os.path.basename(fname), "updated with {0}, {1} lines modified:".format(
+            date_str, sum(1 for line in diff_lines if line.startswith("+"))))
+        for line in diff_lines:
+            print("  " + line)
+
+        _write_atomic(fname, text_out)
+        changed.append(fname)
+
+    return changed
+
+
+def substitute_date_in_readme(readme_fname: str = readme_fname_default,
+                              date_fname: str = date_fname_default):
+    """Put the latest date (datestr as a YYYY.MM.DD format) into the main README.md file.
+
+    The date string is from the file /images/most_recent_date.txt.
+    This shoudl be run at the end of creating a new post in anttoday_social.py.
+
+    Returns True if the README.md was changed at all. False otherwise.
+    """
+    return len(render_files([readme_fname], read_date_str(date_fname))) > 0
 
 
 if __name__ == "__main__":
-    substitute_date_in_readme()
+    parser = argparse.ArgumentParser(description="Put the most recent date into the README.md (and/or other pages).")
+    parser.add_argument("files", nargs="*", default=[readme_fname_default],
+                        help="Files to update. Default: the README.md in the base of the repo.")
+    args = parser.parse_args()
+
+    render_files(args.files, read_date_str())
@@ -1,112 +1,310 @@
-"""Code for creating text (including image alts) for Antarctica Today posts."""
+"""Code for creating text (including image alts) for Antarctica Today posts.
 
+The templates in /data/text_templates.csv are compiled once into a list of segments per text field: literal text
+alternating with the placeholders ([SEASON], [DATE], [YEAR]) that are only known when rendering for a given date.
+Every [FIELDNAME] reference to an ALLCAPS field is resolved at compile time, including references nested inside other
+ALLCAPS fields. The compiled templates are cached on disk next to the CSV, keyed by a hash of the CSV, so they're only
+recompiled when the CSV changes. Rendering a date is then just a single join over each field's segments.
+
+Run this script with a list or range of dates to render the text for all of them at once (e.g. a whole melt season),
+streamed to a CSV or JSON file, with each text checked against every platform's post_limit and alt_text_limit.
+"""
+
+import argparse
+import csv
 import datetime
+import hashlib
+import json
 import os
-import pandas
 import re
+import sys
+
+import atomic_file
+import config_loader
+
+# Bump this whenever the compiled template format changes, so old cache files get recompiled.
+COMPILED_VERSION = 1
+
+text_templates_csvname = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "text_templates.csv"))
+platform_data_csvname = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "platform_data.csv"))
+
+# Placeholders that are filled in for each date when rendering, rather than from text_templates.csv.
+runtime_placeholders = ("SEASON", "DATE", "YEAR")
+
+# A [FIELDNAME] reference in a template. Field names in ALLCAPS are substituted into the other fields.
+placeholder_regex = re.compile(r"\[([A-Z]+)\]")
 
 
 # def ordinal_text(n):
 #     # Take an integer day (e.g. 11), return an ordinal string (e.g. "11th")
 #     return str(n) + ("th" if 4 <= n % 100 <= 20 else {1:"st",2:"nd",3:"rd"}.get(n % 10, "th"))
 
-# A namespace class in which to hold attributes for Antarctica Today text values and make appropriate substitutions.
-class ATTextValues:
-    """Generic class that takes a 2-column pandas dataframe, in which the first column is field names and the
-    second column is field values, and converts it into an object with named attributes.
+def _is_all_caps(in_str: str) -> bool:
+    """Given a string, return whether this is all-capital letters."""
+    return re.search(r"\A[A-Z]+\Z", in_str) is not None
+
+
+def compile_templates(rows: list) -> dict:
+    """Compile a list of (name, value) template rows.
+
+    Any field that is not all caps (usually lower-case and _ characters) is a text field we'll use. Any fieldname that
+    is in ALLCAPS is substituted anywhere in the other strings where [FIELDNAME] is used, and may itself use other
+    [FIELDNAME]s. All r'\\n' text instances become newlines.
+
+    Returns {"fields": {name: segments}}, where segments alternate literal text (even indices) and runtime placeholder
+    names (odd indices). Raises ValueError if ALLCAPS fields refer to each other in a cycle.
     """
+    caps_values = {name: value for (name, value) in rows if _is_all_caps(name)}
+    # Resolved segments of each ALLCAPS field, filled in as they're needed.
+    resolved_caps = {}
 
-    def __init__(self, df, date_str_yyyy_mm_dd):
-        for i, row in df.iterrows():
-            name = row.iloc[0]
-            val = row.iloc[1]
-            setattr(self, name, val)
+    def resolve(template: str, reference_chain: list) -> list:
+        segments = [""]
+        pos = 0
+        for match in placeholder_regex.finditer(template):
+            segments[-1] += template[pos:match.start()]
+            pos = match.end()
+            name = match.group(1)
+
+            if name in caps_values:
+                if name in reference_chain:
+                    raise ValueError("Text templates refer to each other in a cycle: " +
+                                     " -> ".join(["[{0}]".format(n) for n in reference_chain + [name]]))
+                if name not in resolved_caps:
+                    resolved_caps[name] = resolve(caps_values[name], reference_chain + [name])
+                nested_segments = resolved_caps[name]
+                # Stitch the nested field's segments onto ours, merging the literal text at the joins.
+                segments[-1] += nested_segments[0]
+                segments.extend(nested_segments[1:])
+
+            elif name in runtime_placeholders:
+                segments.extend([name, ""])
 
-        self._make_text_substitutions()
-        self._substitute_dates_and_seasons(date_str_yyyy_mm_dd)
-
-    def _make_text_substitutions(self):
-        """Any field this is not all caps (usually lower-case and _ characters) is a text field we'll use.
-        Any fieldname that is in ALLCAPS is substituted anywhere in the other strings where [FIELDNAME] is used.
-        Make those substitutions here.
-
-        Also, substitute all r'\n' text instasnces with newlines (\n).
-        """
-        non_caps_attrs = []
-        all_caps_attrs = []
-        for attr_name in self.__dict__:
-            if self._is_all_caps(attr_name):
-                all_caps_attrs.append(attr_name)
             else:
-                non_caps_attrs.append(attr_name)
-
-        for attr_name in non_caps_attrs:
-            # Get the text template to search through.
-            attr_str = getattr(self, attr_name)
-            # attr_str_orig = attr_str
-
-            for attr_subtitution_label in all_caps_attrs:
-                # Look for any instance of [FIELDNAME] in the string. If it's there, substitute the value.
-                search_str = "[" + attr_subtitution_label + "]"
-                # If we've found it, substitute the text.
-                if attr_str.find(search_str) >= 0:
-                    # Substitute the text.
-                    attr_str = attr_str.replace(search_str, getattr(self, attr_subtitution_label))
-
-            # Substitute newlines.
-            attr_str = attr_str.replace(r'\n', "\n")
-
-            # Then, re-assign the attribute to the new string with substitutions.
-            # print(attr_name, attr_str_orig, "~~>", attr_str, "\n")
-            setattr(self, attr_name, attr_str)
-
-    @staticmethod
-    def _is_all_caps(in_str: str) -> bool:
-        """Given a string, return whether this is all-capital letters."""
-        return re.search(r"\A[A-Z]+\Z", in_str) is not None
-
-    def _substitute_dates_and_seasons(self, yyyy_mm_dd_str):
-        """Replace all instances of [DATE] with a string date, and [SEASON] with a YYYY-YYYYY season string, and [YEAR]."""
-        # Get the date string. Should be in "YYYY.MM.DD" format.
+                # Not something we know how to fill in. Leave it as-is.
+                segments[-1] += match.group(0)
+
+        segments[-1] += template[pos:]
+        return segments
+
+    fields = {}
+    for name, value in rows:
+        if _is_all_caps(name):
+            continue
+        segments = resolve(value, [])
+        # Substitute newlines in the literal text.
+        fields[name] = [seg.replace(r'\n', "\n") if (i % 2 == 0) else seg for (i, seg) in enumerate(segments)]
+
+    return {"fields": fields}
+
+
+def runtime_values(yyyy_mm_dd_str: str) -> dict:
+    """Return the [DATE], [SEASON] and [YEAR] values for a "YYYY.MM.DD" date string."""
+    # Get the date string. Should be in "YYYY.MM.DD" format.
+    dt = datetime.datetime.strptime(yyyy_mm_dd_str, "%Y.%m.%d")
+    # Create a text date string, "2023.12.17" --> Sun December 17, 2023.
+    date_str = dt.strftime("%a %B %-d, %Y")
+
+    year_str = str(datetime.datetime.today().year)
+
+    return {"SEASON": season_string(dt, yyyy_mm_dd_str),
+            "DATE": date_str,
+            "YEAR": year_str}
+
+
+def season_string(dt: datetime.date, yyyy_mm_dd_str: str = None) -> str:
+    """Return the "YYYY-YYYY" melt season a date falls in. Raise ValueError if it's outside the melt season."""
+    # Get the season string. HERE WE ASSUME the Anarctic melt season starts 1 Oct and ends 30 April, annually.
+    # First, see if the date is in the first half or the second half the season.
+    mm_dd_start = (10, 1)
+    mm_dd_end = (4, 30)
+    mm_dd = (dt.month, dt.day)
+    year = dt.year
+    if mm_dd >= mm_dd_start:
+        year1 = year
+        year2 = year + 1
+    elif mm_dd <= mm_dd_end:
+        year1 = year - 1
+        year2 = year
+    else:
+        raise ValueError(f"Year '{yyyy_mm_dd_str or dt}' falls outside the Antarctic melt season "
+                         f"from Oct 1 thru Apr 30.")
+
+    return f"{year1}-{year2}"
+
+
+def render_templates(compiled: dict, yyyy_mm_dd_str: str, values: dict = None) -> dict:
+    """Render each compiled text field for a date. Returns {field name: text}.
+
+    'values' are the runtime placeholder values, if they've already been worked out (see runtime_values())."""
+    if values is None:
+        values = runtime_values(yyyy_mm_dd_str)
+
+    return {name: "".join([seg if (i % 2 == 0) else values[seg] for (i, seg) in enumerate(segments)])
+            for (name, segments) in compiled["fields"].items()}
+
+
+def load_compiled_templates(csv_fname: str = text_templates_csvname) -> dict:
+    """Return the compiled templates for a text templates CSV, from the on-disk cache if the CSV hasn't changed.
+
+    The cache sits next to the CSV (text_templates_compiled.json) and is keyed by the SHA-256 of the CSV's bytes."""
+    assert os.path.exists(csv_fname)
+    with open(csv_fname, 'rb') as f:
+        csv_hash = hashlib.sha256(f.read()).hexdigest()
+
+    cache_fname = os.path.splitext(csv_fname)[0] + "_compiled.json"
+    if os.path.exists(cache_fname):
+        try:
+            with open(cache_fname, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get("version") == COMPILED_VERSION and cached.get("csv_sha256") == csv_hash:
+                return cached
+        except ValueError:
+            pass
+
+    rows = config_loader.read_key_values(csv_fname)
+    compiled = compile_templates(rows)
+    # Keep the rows too, so the raw template values are available without reading the CSV again.
+    compiled.update({"version": COMPILED_VERSION,
+                     "csv_sha256": csv_hash,
+                     "rows": rows})
+
+    # Write to a temp file and move it into place, so a parallel run never reads a half-written cache.
+    with atomic_file.atomic_write(cache_fname, encoding='utf-8') as f:
+        json.dump(compiled, f, ensure_ascii=False)
+
+    return compiled
+
+
+def melt_season_dates(start_yyyy_mm_dd: str, end_yyyy_mm_dd: str) -> list:
+    """Return all the "YYYY.MM.DD" dates from start to end (inclusive) that are in a melt season (Oct 1-Apr 30)."""
+    start = datetime.datetime.strptime(start_yyyy_mm_dd, "%Y.%m.%d").date()
+    end = datetime.datetime.strptime(end_yyyy_mm_dd, "%Y.%m.%d").date()
+
+    return [(start + datetime.timedelta(days=i)).strftime("%Y.%m.%d")
+            for i in range((end - start).days + 1)
+            if not (5 <= (start + datetime.timedelta(days=i)).month <= 9)]
+
+
+def runtime_values_for_dates(dates: list) -> list:
+    """Work out the [DATE], [SEASON] and [YEAR] values for a list of "YYYY.MM.DD" dates, the same as runtime_values()
+    for each one, but only working out each season string and the current year once."""
+    year_str = str(datetime.datetime.today().year)
+    season_strs = {}
+
+    values_list = []
+    for yyyy_mm_dd_str in dates:
         dt = datetime.datetime.strptime(yyyy_mm_dd_str, "%Y.%m.%d")
-        # Create a text date string, "2023.12.17" --> Sun December 17, 2023.
-        date_str = dt.strftime("%a %B %-d, %Y")
-        # Get the season string. HERE WE ASSUME the Anarctic melt season starts 1 Oct and ends 30 April, annually.
-        # First, see if the date is in the first half or the second half the season.
-        mm_dd_start = (10, 1)
-        mm_dd_end = (4, 30)
-        mm_dd = (dt.month, dt.day)
-        year = dt.year
-        if mm_dd >= mm_dd_start:
-            year1 = year
-            year2 = year + 1
-        elif mm_dd <= mm_dd_end:
-            year1 = year - 1
-            year2 = year
+        # Every date in the same year and half of the year is in the same season. (Dates from May thru Sep aren't in
+        # a season at all, so always let season_string() raise its error for those.)
+        season_key = (dt.year, dt.month >= 10)
+        if season_key not in season_strs or 5 <= dt.month <= 9:
+            season_strs[season_key] = season_string(dt, yyyy_mm_dd_str)
+
+        values_list.append({"SEASON": season_strs[season_key],
+                            "DATE": dt.strftime("%a %B %-d, %Y"),
+                            "YEAR": year_str})
+
+    return values_list
+
+
+def generate_texts_for_dates(dates: list, compiled: dict = None):
+    """Render the text fields for each of a list of "YYYY.MM.DD" dates, reusing one compiled copy of the templates.
+
+    Yields (date string, {field name: text}) for each date, in order."""
+    if compiled is None:
+        compiled = load_compiled_templates(text_templates_csvname)
+
+    for yyyy_mm_dd_str, values in zip(dates, runtime_values_for_dates(dates)):
+        yield yyyy_mm_dd_str, render_templates(compiled, yyyy_mm_dd_str, values=values)
+
+
+def read_platform_limits(csvname: str = platform_data_csvname) -> list:
+    """Return the (platform_name, post_limit, alt_text_limit, text_addition) of each platform in platform_data.csv."""
+    return [(row["platform_name"],
+             int(row["post_limit"]),
+             int(row["alt_text_limit"]),
+             row.get("text_addition", "").replace(r'\n', "\n"))
+            for row in config_loader.read_table(csvname)]
+
+
+def text_limit_problems(texts: dict, platform_limits: list) -> list:
+    """Check a date's rendered texts against each platform's limits. The post text is checked with the platform's
+    text_addition on the end, the same as it gets posted. Returns a list of "platform:field(length/limit)" strings."""
+    problems = []
+    for platform_name, post_limit, alt_text_limit, text_addition in platform_limits:
+        for field_name, text in texts.items():
+            if field_name == "post":
+                length, limit = len(text + text_addition), post_limit
+            elif field_name.endswith("_alt"):
+                length, limit = len(text), alt_text_limit
+            else:
+                continue
+
+            if length > limit:
+                problems.append("{0}:{1}({2}/{3})".format(platform_name, field_name, length, limit))
+
+    return problems
+
+
+def write_texts_for_dates(dates: list,
+                          out_file,
+                          out_format: str = "csv",
+                          platform_limits: list = None) -> list:
+    """Render the texts for each date and write them to an open file as they're made, as CSV rows or a JSON list.
+
+    Each row has the date, each text field, and the "over_limit" problems found by text_limit_problems() (if
+    platform_limits are given). Returns a list of the (date, problems) for each date with any problems."""
+    assert out_format in ("csv", "json")
+    compiled = load_compiled_templates(text_templates_csvname)
+    field_names = list(compiled["fields"].keys())
+    dates_with_problems = []
+
+    if out_format == "csv":
+        writer = csv.writer(out_file)
+        writer.writerow(["date"] + field_names + ["over_limit"])
+    else:
+        out_file.write("[")
+
+    for i, (yyyy_mm_dd_str, texts) in enumerate(generate_texts_for_dates(dates, compiled)):
+        problems = [] if platform_limits is None else text_limit_problems(texts, platform_limits)
+        if len(problems) > 0:
+            dates_with_problems.append((yyyy_mm_dd_str, problems))
+
+        if out_format == "csv":
+            writer.writerow([yyyy_mm_dd_str] + [texts[name] for name in field_names] + [";".join(problems)])
         else:
-            raise ValueError(f"Year '{yyyy_mm_dd_str}' falls outside the Antarctic melt season from Oct 1 thru Apr 30.")
+            out_file.write(("\n" if i == 0 else ",\n") +
+                           json.dumps(dict(date=yyyy_mm_dd_str, over_limit=problems, **texts), ensure_ascii=False))
+
+    if out_format == "json":
+        out_file.write("\n]\n")
+
+    return dates_with_problems
+
 
-        season_str = f"{year1}-{year2}"
+# A namespace class in which to hold attributes for Antarctica Today text values and make appropriate substitutions.
+class ATTextValues:
+    """Generic class that takes a list of (name, value) rows, or a 2-column pandas dataframe in which the first
+    column is field names and the second column is field values, and converts it into an object with named attributes.
 
-        year_str = str(datetime.datetime.today().year)
+    The text fields come out with all their [FIELDNAME], [DATE], [SEASON] and [YEAR] substitutions made. ALLCAPS fields
+    keep their values from the templates. If the rows have already been compiled (see compile_templates()), pass that
+    in as 'compiled' to skip compiling them again.
+    """
 
-        season_search_str = "[SEASON]"
-        date_search_str = "[DATE]"
-        year_search_str = "[YEAR]"
+    def __init__(self, rows, date_str_yyyy_mm_dd, compiled: dict = None):
+        if hasattr(rows, "iterrows"):
+            rows = [(row.iloc[0], row.iloc[1]) for i, row in rows.iterrows()]
+
+        for name, val in rows:
+            setattr(self, name, val)
 
-        # Get all the lower-cased attributes.
-        non_caps_attrs = [attrname for attrname in self.__dict__ if not self._is_all_caps(attrname)]
-        for attrname in non_caps_attrs:
-            attr_str = getattr(self, attrname)
-            # print(attrname, attr_str, "-->")
-            attr_str = attr_str.replace(season_search_str, season_str)\
-                               .replace(date_search_str, date_str)\
-                               .replace(year_search_str, year_str)
-            # print(attr_str)
-            # Assign it back into the attribute place.
-            setattr(self, attrname, attr_str)
+        if compiled is None:
+            compiled = compile_templates(rows)
 
-        return
+        for name, text in render_templates(compiled, date_str_yyyy_mm_dd).items():
+            setattr(self, name, text)
 
 
 def generate_text_objects(datestr):
@@ -122,18 +320,11 @@ def generate_text_objects(datestr):
     .anomaly_map_alt: Alt-text for the seasonal anomaly-of-melt-days map.
     .line_plot_alt: Alt-text for the line plot of the season so far.
     """
-    # First, find and open the text_template.csv file.
-    csv_fname = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "text_templates.csv"))
-    assert os.path.exists(csv_fname)
-
-    # Read the CSV, convert it to a namespace object so we can directly get at the attributes without traversing tables.
-    df = pandas.read_csv(csv_fname, comment="#", names=["name", "value"])
-    # For some stupid reason (I'm too lazy to debug with Pandas right now), the comment line is being read in as a
-    # data row despite starting with "#". Filter out comment lines specifically here.
-    df = df[~df.name.str.startswith("#")]
+    # Get the compiled templates (compiled only if text_template.csv has changed since last time), and render them.
+    compiled = load_compiled_templates(text_templates_csvname)
 
-    # Create the attribute object and make all the correct substitutions.
-    text_obj = ATTextValues(df, datestr)
+    # Create the attribute object with all the correct substitutions.
+    text_obj = ATTextValues(compiled["rows"], datestr, compiled=compiled)
     # The text fields we should reference are:
     # - post
     # - daily_melt_map_alt
@@ -143,5 +334,46 @@ def generate_text_objects(datestr):
     return text_obj
 
 
+def define_and_parse_args():
+    parser = argparse.ArgumentParser(description="Generate the post text and image alt-texts for one or more dates, "
+                                                 "and check them against each platform's length limits.")
+    parser.add_argument("dates", type=str, nargs="*", default=[],
+                        help="Dates to generate text for, in YYYY.MM.DD format.")
+    parser.add_argument("-start", type=str, default="",
+                        help="Generate text for every melt-season date from this date (YYYY.MM.DD)...")
+    parser.add_argument("-end", type=str, default="",
+                        help="...to this date (YYYY.MM.DD), inclusive. Default: the same as -start.")
+    parser.add_argument("-output", "-o", type=str, default="",
+                        help="File to write the texts to. Default: print them out.")
+    parser.add_argument("-format", "-f", type=str, default="", choices=["", "csv", "json"],
+                        help="Output format. Default: from the -output file extension, or csv.")
+
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    print(generate_text_objects("2023.12.16").__dict__)
+    args = define_and_parse_args()
+
+    dates = list(args.dates)
+    if args.start != "":
+        dates.extend(melt_season_dates(args.start, args.end if args.end != "" else args.start))
+    if len(dates) == 0:
+        dates = ["2023.12.16"]
+
+    out_format = args.format
+    if out_format == "":
+        out_format = "json" if args.output.lower().endswith(".json") else "csv"
+
+    limits = read_platform_limits() if os.path.exists(platform_data_csvname) else None
+
+    if args.output == "":
+        problem_dates = write_texts_for_dates(dates, sys.stdout, out_format, limits)
+    else:
+        with open(args.output, 'w', newline='', encoding='utf-8') as f:
+            problem_dates = write_texts_for_dates(dates, f, out_format, limits)
+        print(len(dates), "dates written to", args.output)
+
+    if limits is None:
+        print("No platform_data.csv found. Lengths were not checked.", file=sys.stderr)
+    for date_str, problems in problem_dates:
+        print("{0} is over the limit: {1}".format(date_str, ", ".join(problems)), file=sys.stderr)
@@ -4,23 +4,34 @@ anttoday_app_baseclass.py - A base class for making posts to various social medi
 Created by Mike MacFerrin
 """
 
+import concurrent.futures
+import csv
 import datetime
+import io
+import json
 import os
-import pandas
 import re
 import shutil
+import time
+
+import atomic_file
+import config_loader
+import image_preprocessing
+import post_history_store
+import thread_cache
 
 
 # A generate empty namespace class in which to hold attributes. Used by AntTodayAppBaseClass::df_to_object() method.
 class NamespaceValues:
-    """Generic class that takes a 2-column pandas dataframe, in which the first column is field names and the
-    second column is field values, and converts it into an object with named attributes.
+    """Generic class that takes a list of (name, value) rows, or a 2-column pandas dataframe in which the first
+    column is field names and the second column is field values, and converts it into an object with named attributes.
     """
 
-    def __init__(self, df):
-        for i, row in df.iterrows():
-            name = row.iloc[0]
-            val = row.iloc[1]
+    def __init__(self, rows):
+        if hasattr(rows, "iterrows"):
+            rows = [(row.iloc[0], row.iloc[1]) for i, row in rows.iterrows()]
+
+        for name, val in rows:
             setattr(self, name, val)
 
 
@@ -58,6 +69,13 @@ class PostInfo:
         self.img4_alt = "" if img4_alt is None else img4_alt.replace("\n", r'\n')
         self.comments = comments
 
+    @classmethod
+    def from_dict(cls, fields: dict):
+        """Create a PostInfo object from a dictionary of its (already-formatted) attributes, e.g. from PostInfo.__dict__."""
+        post_info = cls(post_id=fields["post_id"])
+        post_info.__dict__.update(fields)
+        return post_info
+
     def list(self):
         """Convert the fields to a dict for easy import into pandas rows."""
         return [
@@ -87,14 +105,44 @@ class AntTodayAppBaseClass:
         self.platform_name = platform_name
         self.username = None
         self.credentials_obj = None
-        self.post_history_df = None
+        # The post history as a pandas dataframe, read the first time self.post_history_df is used (see below).
+        self._post_history_df = None
         self.post_history_csv_fname = None
+        # If the platform's "post_history_backend" is "sqlite" or "journal", the post history is kept in a
+        # SQLitePostHistoryStore or JournaledPostHistoryStore rather than rewriting the CSV each time.
+        self.post_history_store = None
         self.post_limit = None
         self.alt_text_limit = None
         self.text_addition = ''
+        # How many of a post's images to upload at the same time.
+        self.max_upload_workers = 4
+        # Images are fit into these limits before being uploaded (see image_preprocessing.py). Sub-classes set these
+        # to the platform's limits. They can be overridden by the "image_max_bytes" and "image_max_dimension" columns
+        # in platform_data.csv. None means no limit.
+        self.image_max_bytes = None
+        self.image_max_dimension = None
+        # A media_upload_cache.MediaUploadCache of recent image uploads, set up by sub-classes.
+        self.media_upload_cache = None
         self.session = None
         self.thread_posts_cache = None
         self.top_post_id = None
+        # If True, thread syncs resume from the last synced post in the post history rather than re-walking the whole
+        # thread from the top post. Set to False to force a full re-walk.
+        self.incremental_sync = True
+        # A persistent cache of the thread posts, saved in the /data/ directory between runs.
+        self.thread_cache = thread_cache.ThreadCache(platform_name)
+        self.use_thread_cache = True
+        # A small local record of the latest post in our thread, with whatever we need to reply to it.
+        self.tail_index_fname = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                             "..",
+                                                             "data",
+                                                             "tail_index_{0}.json".format(platform_name)))
+        # A tail index entry written this recently (usually by our own last post, e.g. when posting several days in a
+        # row) is trusted as-is, without looking the post up online first. Older entries are confirmed with one lookup.
+        self.tail_index_trust_seconds = 10 * 60
+        # When backfilling several days at once, wait at least this long between posts, to stay well within the
+        # platform's rate limits. Sub-classes set this.
+        self.backfill_post_interval_seconds = 0
 
     def df_to_object(self, df):
         """For a simple 2-column dataframe where the first column is an attribute name and the second is a data value,
@@ -115,49 +163,123 @@ class AntTodayAppBaseClass:
                                                              "data",
                                                              "platform_data.csv"))
         assert os.path.exists(platform_data_csvname)
-        platform_data_df = pandas.read_csv(platform_data_csvname, comment="#").replace(pandas.NA, '')
+        # This is a small file, so read it with the csv module rather than pandas (see config_loader.py).
+        platform_data_rows = config_loader.read_table(platform_data_csvname)
 
         # Find the one entry that mathes our platform.
-        platform_data_entry = platform_data_df[platform_data_df["platform_name"] == self.platform_name]
+        platform_data_entry = [row for row in platform_data_rows if row["platform_name"] == self.platform_name]
         # Make sure an entry exists for this platform.
         assert len(platform_data_entry) == 1
 
-        platform_data_row = platform_data_entry.iloc[0]
+        platform_data_row = platform_data_entry[0]
+
+        self.post_limit = int(platform_data_row["post_limit"])
+        self.alt_text_limit = int(platform_data_row["alt_text_limit"])
+        self.username = platform_data_row["username"]
+        self.text_addition = platform_data_row.get("text_addition", "").replace(r'\n', "\n")
 
-        self.post_limit = platform_data_row.post_limit
-        self.alt_text_limit = platform_data_row.alt_text_limit
-        self.username = platform_data_row.username
-        self.text_addition = "" if \
-            (platform_data_row.text_addition is None
-             or platform_data_row.text_addition == ""
-             or pandas.isna(platform_data_row.text_addition)
-             ) \
-            else platform_data_row.text_addition.replace(r'\n', "\n")
+        # Optional image limits, if we want something different from the platform's defaults.
+        for limit_name in ("image_max_bytes", "image_max_dimension"):
+            limit_value = platform_data_row.get(limit_name, "").strip()
+            if limit_value != "":
+                setattr(self, limit_name, int(limit_value))
 
         # Find the post history CSV in the same "data" directory as the overall platform_data file.
         post_history_csv_fname = os.path.join(os.path.dirname(platform_data_csvname),
-                                              platform_data_row.post_history_file)
-        assert os.path.exists(post_history_csv_fname)
-
-        self.post_history_df = pandas.read_csv(post_history_csv_fname,
-                                               comment="#",
-                                               keep_default_na=False,
-                                               index_col='post_id').replace(pandas.NA, '')
+                                              platform_data_row["post_history_file"])
         self.post_history_csv_fname = post_history_csv_fname
-        self.top_post_id = self.post_history_df.iloc[0].name
+
+        # The "post_history_backend" column is optional. Blank or "csv" means just use the CSV file.
+        post_history_backend = platform_data_row.get("post_history_backend", "").strip().lower()
+        if post_history_backend == "sqlite":
+            # The database sits next to the CSV. The first time through, import the existing CSV into it.
+            self.post_history_store = post_history_store.SQLitePostHistoryStore(
+                os.path.splitext(post_history_csv_fname)[0] + ".sqlite")
+            if self.post_history_store.is_empty():
+                assert os.path.exists(post_history_csv_fname)
+                self.post_history_store.import_csv(post_history_csv_fname)
+        elif post_history_backend == "journal":
+            # The CSV is the snapshot, with changes appended to a journal file next to it.
+            assert os.path.exists(post_history_csv_fname)
+            self.post_history_store = post_history_store.JournaledPostHistoryStore(post_history_csv_fname)
+        else:
+            assert post_history_backend in ("", "csv")
+            assert os.path.exists(post_history_csv_fname)
+
+        # The post history dataframe itself isn't read until it's needed (which means importing pandas). Posting and
+        # syncing the thread work on the plain rows, so they never need it.
+        self._post_history_df = None
+        self.top_post_id = self.first_post_id()
 
         # Find the credentials CSV in the "credentials" folder.
         credentials_csv_fname = os.path.join(os.path.dirname(platform_data_csvname),
                                              "..", "credentials",
-                                             platform_data_row.credentials_file)
+                                             platform_data_row["credentials_file"])
         assert os.path.exists(credentials_csv_fname)
 
-        self.credentials_obj = self.df_to_object(pandas.read_csv(credentials_csv_fname, header=None))
+        self.credentials_obj = NamespaceValues(config_loader.read_key_values(credentials_csv_fname))
 
         # print(self.platform_name)
         # print(self.post_history_df)
         # print(self.credentials_obj, [attr for attr in dir(self.credentials_obj) if attr[0] != "_"])
 
+    @property
+    def post_history_df(self):
+        """The post history as a pandas dataframe indexed by post_id. Read (and pandas imported) on first use."""
+        if self._post_history_df is None and self.post_history_csv_fname is not None:
+            self._post_history_df = self.read_post_history_df()
+        return self._post_history_df
+
+    @post_history_df.setter
+    def post_history_df(self, post_df):
+        self._post_history_df = post_df
+
+    def read_post_history_df(self):
+        """Read the post history into a dataframe indexed by post_id, from the post history store or the CSV."""
+        import pandas
+
+        if self.post_history_store is not None:
+            # Go through the CSV format so the column types come out the same as reading the CSV directly.
+            csv_source = io.StringIO(self.post_history_store.export_csv_text())
+        else:
+            csv_source = self.post_history_csv_fname
+
+        return pandas.read_csv(csv_source,
+                               comment="#",
+                               keep_default_na=False,
+                               index_col='post_id').replace(pandas.NA, '')
+
+    def _post_history_csv_rows(self) -> list:
+        """The post history CSV's rows as dictionaries, read without pandas. Only used when there's no store."""
+        return config_loader.read_table(self.post_history_csv_fname)
+
+    def first_post_id(self) -> str:
+        """Return the post_id of the first entry in the post history (the top post of the thread)."""
+        if self._post_history_df is not None:
+            return self._post_history_df.index.values[0]
+        if self.post_history_store is not None:
+            return self.post_history_store.first_post_id()
+
+        return self._post_history_csv_rows()[0]["post_id"]
+
+    def last_post_id(self) -> str:
+        """Return the post_id of the last entry in the post history."""
+        if self._post_history_df is not None:
+            return self._post_history_df.index.values[-1]
+        if self.post_history_store is not None:
+            return self.post_history_store.tail_post_id()
+
+        return self._post_history_csv_rows()[-1]["post_id"]
+
+    def last_date_covered(self) -> str:
+        """Return the latest "date_covered" in the post history."""
+        if self._post_history_df is not None:
+            return max(self._post_history_df["date_covered"].tolist())
+        if self.post_history_store is not None:
+            return self.post_history_store.last_date_covered()
+
+        return max(row["date_covered"] for row in self._post_history_csv_rows())
+
     def open_connection(self):
         """Connect to the server and get ready to post."""
         # If we haven't already logged in, do so.
@@ -177,102 +299,95 @@ class AntTodayAppBaseClass:
     def update_thread_data_file(self,
                                 new_date_covered: str = None,
                                 new_comment: str = None,
-                                overwrite: bool = True):
+                                overwrite: bool = True) -> list:
         """Go through the thread using the base ID, and fill in whatever missing data is in the post_history csv to bring
         it up to speed.
 
-        The base_id should be the post_id of the first entry in the CSV.
+        The base_id should be the post_id of the first entry in the CSV. Returns the post history rows (as
+        dictionaries, in thread order). This works on plain rows rather than a dataframe, so it doesn't need pandas.
         """
         # Open up the post history, retreive the first post_id.
-        if self.post_history_df is None:
+        if self.post_history_csv_fname is None:
             self.populate_metadata()
 
-        assert self.post_history_df is not None
-        post_df = self.post_history_df
+        assert self.post_history_csv_fname is not None
+        if self.post_history_store is not None:
+            columns = self.post_history_store.csv_columns()
+            post_rows = self.post_history_store.read_rows()
+        else:
+            columns = config_loader.read_rows(self.post_history_csv_fname)[0]
+            post_rows = self._post_history_csv_rows()
+
+        # The rows keyed by post_id (as text, the way they're stored), in thread order.
+        rows_by_id = {row["post_id"]: row for row in post_rows}
+        # We shouldn't have repeat lines in this CSV.
+        assert len(rows_by_id) == len(post_rows)
 
         # Fetch the ID of the root post from the table.
-        post_ids = post_df.index.tolist()
-        first_post_id = post_ids[0]
+        first_post_id = post_rows[0]["post_id"]
 
         # Get the list of all the posts from online.
         online_post_list = self.retrieve_post_thread(first_post_id, return_as_postinfo_objects=True)
 
-        # print(post_df)
-
         # Fill in the values for any line that has either incomplete data (defined if the timestamp is unfilled)
-        # or no data for an entry at all (in which case, add a line).
-        info_changed = False
-
+        # or no data for an entry at all (in which case, add a line at the end, in thread order).
+        # Keep track of which rows changed, so a post history store only needs to write those.
+        changed_post_ids = []
         for post_info in online_post_list:
-            matching_lines = post_df.loc[post_df.index == post_info.post_id]
-            # If there is no post with this post_id, add it in new.
-            if len(matching_lines) == 0:
-                new_line = pandas.DataFrame(data=post_info.__dict__,
-                                            index=[0]).set_index('post_id').replace(pandas.NA, '')
-                # print(post_df)
-                # print(post_df.columns)
-                # print(new_line)
-                # print(new_line.columns)
-                post_df = pandas.concat([post_df, new_line])
-                info_changed = True
-                continue
-
-            # If we do have a matching line, it'd better only be one. Otherwise we have repeat lines in this CSV, which
-            # shouldn't be.
-            assert len(matching_lines) == 1
-
-            # If the row already has data, just move alone.
-            if not (pandas.isnull(matching_lines['timestamp'].iloc[0]) or (matching_lines['timestamp'].iloc[0] == '')):
+            online_row = {col: "" if val is None else str(val) for (col, val) in post_info.__dict__.items()}
+            post_id = online_row["post_id"]
+            if post_id in changed_post_ids:
                 continue
 
-            # Otherwise, fill in this row with the data
-            # post_df.set_index('post_id')
-            post_newline = pandas.DataFrame(data=post_info.__dict__,
-                                            index=[0]).set_index('post_id').replace(pandas.NA, '')
-            post_df.update(post_newline)
-            # post_df.loc[post_df['post_id'] == post_info.post_id, :] = post_info.list()
-            info_changed = True
-
-        # Just use empty strings for nan values. Just to make sure here (probably redundant but oh well.
-        post_df = post_df.replace(pandas.NA, '')
+            if post_id not in rows_by_id:
+                rows_by_id[post_id] = online_row
+                changed_post_ids.append(post_id)
+            elif rows_by_id[post_id]["timestamp"] == "":
+                # "date_covered" and "comments" are only ever set locally (e.g. by record_new_post()), so keep those.
+                rows_by_id[post_id].update({col: val for (col, val) in online_row.items()
+                                            if col not in ("date_covered", "comments")})
+                changed_post_ids.append(post_id)
 
-        # print(post_df)
-        # print(post_df.index.equals(last_post_id))
+        info_changed = len(changed_post_ids) > 0
 
         # When we put a new post in this thread, the very last entry should have no "data_covered" field entered.
         # We provide that. Enter it here.
         if info_changed or (new_date_covered is not None) or (new_comment is not None):
-            last_date_covered = post_df.iloc[len(post_df) - 1]['date_covered']
-            last_post_id = post_df.index.values[-1]
-            # print("LAST_POST_ID", last_post_id)
-            # assert type(last_post_id) in (str, int)
-            # Assign the new date covered into the post and update the dataframe with that line.
-            # It will insert the dataframe in the right spot since we're using the same post_id as an index.
-            if last_date_covered == "":
-                # print(last_line)
-                post_df.loc[post_df.index.values == last_post_id, "date_covered"] = new_date_covered
-                # print(last_line)
-                # post_df.update(last_line)
+            last_post_id = next(reversed(rows_by_id))
+            last_row = rows_by_id[last_post_id]
+            if last_row["date_covered"] == "" and new_date_covered is not None:
+                last_row["date_covered"] = new_date_covered
+                changed_post_ids.append(last_post_id)
                 info_changed = True
 
             # If we've added a new comment, put it here. Doesn't matter if we overwrite it.
             if new_comment is not None:
                 assert type(new_comment) is str
-                post_df.loc[post_df.index.values == last_post_id, "comments"] = new_comment
+                last_row["comments"] = new_comment
+                changed_post_ids.append(last_post_id)
                 info_changed = True
 
-        # print(post_df["date_covered"])
+        post_rows = list(rows_by_id.values())
 
-        # print(post_df)
-        # print(post_df.columns)
-        # for colname in post_df.columns:
-        #     print(colname, post_df[colname])
+        # If the information was changed, write it back out.
+        if info_changed and overwrite:
+            self._write_post_history(columns, post_rows, [rows_by_id[post_id] for post_id in
+                                                          dict.fromkeys(changed_post_ids)])
+            # If the dataframe was already read, it's out of date now. It gets read again the next time it's used.
+            self._post_history_df = None
 
-        # print(post_df)
-        # print(post_df['timestamp'])
+        return post_rows
 
-        # If the information was changed, write back out the csv.
-        if info_changed and overwrite:
+    def _write_post_history(self, columns: list, post_rows: list, changed_rows: list):
+        """Write out the post history after some rows have changed.
+
+        With a post history store, only the changed rows are written to it. Otherwise the whole CSV is rewritten."""
+        if self.post_history_store is not None:
+            self.post_history_store.upsert_rows(changed_rows)
+            print(os.path.basename(self.post_history_store.store_fname),
+                  "updated with {0} changed entries ({1} total).".format(len(changed_rows), len(post_rows)))
+
+        else:
             # First, create a backup of the old csv.
             base, ext = os.path.splitext(self.post_history_csv_fname)
             csv_old_name = base + "_old" + ext
@@ -281,19 +396,51 @@ class AntTodayAppBaseClass:
             shutil.copyfile(self.post_history_csv_fname, csv_old_name)
 
             # Save it to the CSV.
-            post_df.to_csv(self.post_history_csv_fname,
-                           mode='w',
-                           na_rep='')
-            # index=False)
-            print(os.path.basename(self.post_history_csv_fname), "written with {0} entries.".format(len(post_df)))
+            with open(self.post_history_csv_fname, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f, lineterminator="\n")
+                writer.writerow(columns)
+                writer.writerows([row.get(col, "") for col in columns] for row in post_rows)
+            print(os.path.basename(self.post_history_csv_fname), "written with {0} entries.".format(len(post_rows)))
             print("(Previous {0} --> {1} as backup.)".format(os.path.basename(self.post_history_csv_fname),
                                                              os.path.basename(csv_old_name)))
 
-        # Save it to the object parameter storing the current df. Overwrite the old one. If nothing was changed this
-        # should be exactly the same.
-        self.post_history_df = post_df
-
-        return post_df
+    def record_new_post(self, post_info: PostInfo):
+        """Add a post we just made to the end of the post history right away, without syncing the thread again.
+
+        The timestamp is left blank, so the next thread sync (update_thread_data_file) fills in the rest of the row
+        from online. Used when posting several days in a row, so each post is on record as soon as it's made.
+
+        The row is just appended to the post history store or CSV, so this doesn't need pandas."""
+        assert str(post_info.post_id) != str(self.last_post_id())
+        row = dict(post_info.__dict__)
+
+        if self.post_history_store is not None:
+            self.post_history_store.upsert_rows([row])
+        else:
+            self._append_post_history_csv_row(row)
+
+        # If the dataframe was already read (so pandas is already imported), keep it in step with what's on disk.
+        if self._post_history_df is not None:
+            import pandas
+            new_row = pandas.DataFrame(data=[row], dtype=object).set_index('post_id').replace(pandas.NA, '')
+            self._post_history_df = pandas.concat([self._post_history_df, new_row]).replace(pandas.NA, '')
+
+    def _append_post_history_csv_row(self, row: dict):
+        """Append one row to the end of the post history CSV, in the CSV's own column order."""
+        columns = config_loader.read_rows(self.post_history_csv_fname)[0]
+        # Make sure the new row starts on its own line.
+        needs_newline = False
+        if os.path.getsize(self.post_history_csv_fname) > 0:
+            with open(self.post_history_csv_fname, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+
+        with open(self.post_history_csv_fname, 'a', newline='', encoding='utf-8') as f:
+            if needs_newline:
+                f.write("\n")
+            csv.writer(f, lineterminator="\n").writerow(["" if row.get(col) is None else str(row[col])
+                                                         for col in columns])
+        print(os.path.basename(self.post_history_csv_fname), "appended with post {0}.".format(row["post_id"]))
 
     def retrieve_post_thread(self,
                              top_post_id: str,
@@ -307,19 +454,142 @@ class AntTodayAppBaseClass:
             "Virtual base class method " + str(self.retrieve_post_thread) + " should not be called."
                                                                             " Method should be overridden by sub-class implementation.")
 
+    def get_sync_anchor(self):
+        """Return the (post_id, reply_to_id) of the last post that has already been synced from online. This is where
+        an incremental thread sync can resume from.
+
+        That's the tail of the on-disk thread cache if there is one, otherwise the last post in the post history.
+        Rows without a timestamp haven't been filled in from online yet, so they aren't used as anchors.
+        Returns (None, None) if incremental syncing is off, or if there's no synced post after the top post.
+        """
+        if not self.incremental_sync:
+            return None, None
+
+        if self.use_thread_cache:
+            anchor_id, anchor_reply_to_id = self.thread_cache.get_tail(self.top_post_id)
+            if anchor_id is not None and str(anchor_id) != str(self.top_post_id):
+                return anchor_id, anchor_reply_to_id
+
+        if self.post_history_store is not None:
+            anchor_id, anchor_reply_to_id = self.post_history_store.last_synced_post()
+            if anchor_id is None or str(anchor_id) == str(self.top_post_id):
+                return None, None
+            return anchor_id, anchor_reply_to_id
+
+        if self.post_history_csv_fname is None:
+            return None, None
+
+        for row in reversed(self._post_history_csv_rows()):
+            if row["timestamp"] != "":
+                # If the anchor is the top post, an incremental sync is the same thing as a full one.
+                if row["post_id"] == str(self.top_post_id):
+                    return None, None
+                return row["post_id"], row["reply_to_id"]
+
+        return None, None
+
+    def update_thread_cache(self, top_post_id, postinfo_objects: list) -> list:
+        """Merge a run of newly-retrieved PostInfo objects into the on-disk thread cache.
+
+        Returns the PostInfo objects for the whole cached run of the thread, or just the ones given if the cache is off.
+        """
+        if not self.use_thread_cache:
+            return postinfo_objects
+
+        merged_posts = self.thread_cache.merge_posts(top_post_id, [post_info.__dict__ for post_info in postinfo_objects])
+        return [PostInfo.from_dict(post_dict) for post_dict in merged_posts]
+
     def _login(self):
         """Simple base-class virtual definition utiilized by sub-classes. Return an active session object."""
         raise NotImplementedError("Virtual base class method " + str(self._login) + " should not be called."
                                                                                     " Method should be overridden by sub-class implementation.")
 
+    def read_tail_index(self):
+        """Return the tail index entry (a dictionary) for the latest post in this thread, or None if there isn't one.
+
+        Every entry has "top_post_id" and "post_id" keys. Sub-classes add whatever else they need to reply to the post.
+        """
+        if not os.path.exists(self.tail_index_fname):
+            return None
+
+        try:
+            with open(self.tail_index_fname, 'r') as f:
+                tail_entry = json.load(f)
+        except ValueError:
+            return None
+
+        # Only use it if it's for the thread we're in now.
+        if str(tail_entry.get("top_post_id")) != str(self.top_post_id):
+            return None
+
+        return tail_entry
+
+    def update_tail_index(self, tail_entry: dict):
+        """Save a new tail index entry for the latest post in this thread.
+
+        The file is written to a temp file and then moved into place, so it's never left half-written.
+        """
+        tail_entry = dict(tail_entry, top_post_id=self.top_post_id, updated=time.time())
+
+        with atomic_file.atomic_write(self.tail_index_fname) as f:
+            json.dump(tail_entry, f, default=str)
+
+    def is_tail_index_fresh(self, tail_entry: dict) -> bool:
+        """Return True if a tail index entry was written recently enough to trust without confirming it online."""
+        updated = tail_entry.get("updated")
+        return updated is not None and (time.time() - float(updated)) <= self.tail_index_trust_seconds
+
+    def _confirm_tail_post(self, tail_entry: dict):
+        """Simple base-class virtual definition utiilized by sub-classes.
+
+        Look up the post in the tail index entry (in a single request) and return the platform's post object for it,
+        or None if it's gone, changed, or no longer the latest post in the thread."""
+        raise NotImplementedError("Virtual base class method " + str(self._confirm_tail_post) + " should not be called."
+                                                                                                " Method should be overridden by sub-class implementation.")
+
+    def _tail_index_entry(self, post) -> dict:
+        """Simple base-class virtual definition utiilized by sub-classes. Return a tail index entry for a post object."""
+        raise NotImplementedError("Virtual base class method " + str(self._tail_index_entry) + " should not be called."
+                                                                                               " Method should be overridden by sub-class implementation.")
+
     def find_latest_thread_post(self):
         """Find the latest thread post.
 
         First will find the latest post in the thread that came from us (not in reply to others' posts, only ours).
+
+        If the tail index has an entry for this thread, that post is just confirmed with a single lookup. Only if that
+        fails is the thread itself retrieved.
         """
+        tail_entry = self.read_tail_index()
+        if tail_entry is not None:
+            latest_post = self._confirm_tail_post(tail_entry)
+            if latest_post is not None:
+                return latest_post
+
         posts = self.retrieve_post_thread(self.top_post_id,
                                           return_as_postinfo_objects=False)
-        return posts[-1]
+        latest_post = posts[-1]
+        self.update_tail_index(self._tail_index_entry(latest_post))
+
+        return latest_post
+
+    def upload_images(self, images: list, upload_func) -> list:
+        """Upload a post's images in parallel, with up to self.max_upload_workers uploads at a time.
+
+        'images' is a list of (image filename, alt text) pairs. Pairs without a filename are skipped.
+        upload_func(image filename, alt text) uploads one image and returns whatever the platform needs to attach it.
+        Returns those in the same order as the images. If any upload fails, its exception is raised once all the
+        uploads are done, so the post is never made with only some of its images.
+        """
+        images = [(img_fn, img_alt) for (img_fn, img_alt) in images if img_fn]
+        if len(images) == 0:
+            return []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_upload_workers, len(images))) as executor:
+            futures = [executor.submit(upload_func, img_fn, img_alt) for (img_fn, img_alt) in images]
+            # Leaving the "with" block waits for all of them to finish. Then .result() re-raises any failures.
+
+        return [future.result() for future in futures]
 
     def post(self,
              text: str,
@@ -332,8 +602,12 @@ class AntTodayAppBaseClass:
              image3_alt: str,
              image4: str,
              image4_alt: str,
-             reply_to_latest: bool = True):
-        """Add a post to the thread and record it into the post history."""
+             reply_to_latest: bool = True,
+             sync_history: bool = True):
+        """Add a post to the thread and record it into the post history.
+
+        If sync_history is False, the new post is just added to the end of the post history (see record_new_post())
+        rather than syncing the whole thread again. Call update_thread_data_file() after the last of several posts."""
 
         # Add any needed text additions here, specified in platform_data.csv
         # These are usually just a few icons or emojis that we want to add to the post in a given particular platform.
@@ -341,8 +615,7 @@ class AntTodayAppBaseClass:
             text = text + self.text_addition
 
         # Check to make sure "date_covered" has not already been covered in the database.
-        post_df = self.post_history_df
-        last_date_covered = max(post_df["date_covered"].tolist())
+        last_date_covered = self.last_date_covered()
         # Both dates should be in a "YYYY.MM.DD" format. Verify this.
         assert re.search(r'\A\d{4}\.\d{2}\.\d{2}\Z', date_covered) is not None
         assert re.search(r'\A\d{4}\.\d{2}\.\d{2}\Z', last_date_covered) is not None
@@ -353,13 +626,19 @@ class AntTodayAppBaseClass:
                                                                                      self.platform_name)
                   )
             # Return the latest post in the thread.
-            return self.post_history_df.index.values[-1]
+            return self.last_post_id()
 
 
         # print("New post ({0} chars):".format(len(text)))
         # print(text)
         # FOOBAR
 
+        # Fit the images into the platform's size limits. Images that are already small enough are just optimized.
+        if self.image_max_bytes is not None:
+            image1, image2, image3, image4 = image_preprocessing.preprocess_images([image1, image2, image3, image4],
+                                                                                   self.image_max_bytes,
+                                                                                   self.image_max_dimension)
+
         # Populate the images, alt-text, text, and post. This will use the sub-class "_create_post()" method.
         response = self._create_post(
             text,
@@ -378,14 +657,25 @@ class AntTodayAppBaseClass:
         # Since the thread now updated, we'll delete our previous cache so that it gets redone, and then prompt the
         # thread data to be updated.
         self.thread_posts_cache = None
-        self.update_thread_data_file(new_date_covered=date_covered,
-                                     overwrite=True)
+        if sync_history:
+            self.update_thread_data_file(new_date_covered=date_covered,
+                                         overwrite=True)
+        else:
+            self.record_new_post(PostInfo(post_id=response,
+                                          date_covered=date_covered,
+                                          text=text,
+                                          img1_alt=image1_alt,
+                                          img2_alt=image2_alt,
+                                          img3_alt=image3_alt,
+                                          img4_alt=image4_alt))
         print(os.path.basename(self.post_history_csv_fname), "updated.")
 
         # Get the post_id of the latest post, and return it.
-        return self.post_history_df.index.values[-1]
+        return self.last_post_id()
 
     def TEST_update_post_history_csv(self):
+        import pandas
+
         df = pandas.read_csv(self.post_history_csv_fname,
                              comment="#",
                              keep_default_na=False,
@@ -4,12 +4,14 @@ Currently supporting Mastodon & BlueSky (AT-proto). Not yet supporting Threads a
 
 Created by Mike MacFerrin
 """
+import argparse
+import concurrent.futures
 import os
+import time
 
 import ant_today_text_generator
-import atproto_social
 import git_image_upload
-import mastodon_social
+import platform_registry
 import update_antarctica_today
 
 
@@ -21,16 +23,53 @@ import update_antarctica_today
 
 
 class AntTodaySocialApp:
-    def __init__(self):
-        self.apps = [atproto_social.AntTodayAppATProto(),
-                     mastodon_social.AntTodayAppMastodon()]
-        # self.apps = [atproto_social.AntTodayAppATProto()] # Un-comment to only work in BlueSky (ATProto)
-        # self.apps = [mastodon_social.AntTodayAppMastodon()] # Un-comment to only work in Mastodon.
-
-    def populate_and_connect(self):
-        """Open and populate all the needed platform classes."""
-        for app in self.apps:
-            app.open_and_populate()
+    def __init__(self,
+                 concurrent_platforms: bool = True,
+                 platform_names: list = None):
+        # One app for each platform enabled in platform_data.csv (see platform_registry.py). Or, if platform_names is
+        # given, just those platforms. Only the enabled platforms' backends (and SDKs) get imported.
+        self.apps = platform_registry.create_apps(platform_names)
+
+        # If True, log in, sync, and post on all the platforms at the same time, each in its own thread.
+        # Most of the time is spent waiting on the network, so this takes about as long as the slowest platform.
+        self.concurrent_platforms = concurrent_platforms
+
+    def _run_on_each_app(self, app_func) -> list:
+        """Call app_func(app) for each of the platform apps, in parallel if self.concurrent_platforms is set.
+
+        Returns a list of the results, one per app. If a call raised an exception, the exception is put in its place."""
+        results = [None] * len(self.apps)
+
+        if not self.concurrent_platforms or len(self.apps) <= 1:
+            for i, app in enumerate(self.apps):
+                try:
+                    results[i] = app_func(app)
+                except Exception as e:
+                    results[i] = e
+
+            return results
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.apps)) as executor:
+            futures = [executor.submit(app_func, app) for app in self.apps]
+            for i, future in enumerate(futures):
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    results[i] = e
+
+        return results
+
+    def populate_and_connect(self) -> list:
+        """Open and populate all the needed platform classes.
+
+        Returns a list with None for each platform that connected, or the exception raised if it didn't."""
+        responses = self._run_on_each_app(lambda app: app.open_and_populate())
+
+        for app, response in zip(self.apps, responses):
+            if isinstance(response, Exception):
+                print("ERROR connecting to {0}: {1}".format(app.platform_name, repr(response)))
+
+        return responses
 
     def create_new_post(self) -> list:
         """Update Antarctica Today data and images, generate new text, and post on each social media platform."""
@@ -50,23 +89,21 @@ class AntTodaySocialApp:
         # - line_plot_alt
 
         # Post in each of the sub-apps.
-        responses = [None] * len(self.apps)
-        for i, app in enumerate(self.apps):
-            try:
-                post_id = app.post(text_fields.post,
-                                   date_covered=date_covered,
-                                   image1=at_update_object.daily_melt_map,
-                                   image1_alt=text_fields.daily_melt_map_alt,
-                                   image2=at_update_object.sum_map,
-                                   image2_alt=text_fields.sum_map_alt,
-                                   image3=at_update_object.anomaly_map,
-                                   image3_alt=text_fields.anomaly_map_alt,
-                                   image4=at_update_object.line_plot,
-                                   image4_alt=text_fields.line_plot_alt,
-                                   reply_to_latest=True)
-                responses[i] = post_id
-            except Exception as e:
-                responses[i] = e
+        responses = self._run_on_each_app(lambda app: app.post(text_fields.post,
+                                                               date_covered=date_covered,
+                                                               image1=at_update_object.daily_melt_map,
+                                                               image1_alt=text_fields.daily_melt_map_alt,
+                                                               image2=at_update_object.sum_map,
+                                                               image2_alt=text_fields.sum_map_alt,
+                                                               image3=at_update_object.anomaly_map,
+                                                               image3_alt=text_fields.anomaly_map_alt,
+                                                               image4=at_update_object.line_plot,
+                                                               image4_alt=text_fields.line_plot_alt,
+                                                               reply_to_latest=True))
+
+        for app, response in zip(self.apps, responses):
+            if isinstance(response, Exception):
+                print("ERROR posting to {0}: {1}".format(app.platform_name, repr(response)))
 
         # Upload the new images to the git repository. (This will exit out if the git is alredy current.)
         atgit = git_image_upload.ATGit()
@@ -74,13 +111,108 @@ class AntTodaySocialApp:
 
         return responses
 
+    def backfill_posts(self) -> list:
+        """Post every day of gathered plots newer than each platform's last date_covered, oldest first.
 
-def new_post_on_all_platforms():
-    atoday = AntTodaySocialApp()
+        Catches up after missed daily runs, all in this one session. Each platform posts its missing days in order,
+        replying to its own previous post through the tail index rather than re-syncing the thread each time. Each new
+        post is added to the post history as it's made, and the thread is synced once at the end to fill in the rest.
+        Posts are spaced out by each platform's backfill_post_interval_seconds to keep within its rate limits. The
+        latest images are uploaded to git once, at the end.
+
+        Returns a list, for each platform, of the dates posted (or the exception that stopped it)."""
+        at_update_object = update_antarctica_today.run_update_data()
+        gathered_dates = update_antarctica_today.gathered_plot_dates()
+
+        # The dates each platform still needs to post, oldest first.
+        dates_to_post = {}
+        for app in self.apps:
+            if app.session is None:
+                continue
+            last_date_covered = app.last_date_covered()
+            dates_to_post[app.platform_name] = [datestr for datestr in gathered_dates if datestr > last_date_covered]
+
+        # Render the text and find the images for every date needed, just once for all the platforms.
+        all_dates = sorted(set(datestr for dates in dates_to_post.values() for datestr in dates))
+        text_fields = dict(ant_today_text_generator.generate_texts_for_dates(all_dates))
+        at_image_objects = {datestr: update_antarctica_today.get_atimages_object_from_dirname(
+            os.path.join(update_antarctica_today.at_gathered_plots_dir, datestr)) for datestr in all_dates}
+
+        def backfill_app(app):
+            dates_posted = []
+            try:
+                for datestr in dates_to_post.get(app.platform_name, []):
+                    if len(dates_posted) > 0:
+                        time.sleep(app.backfill_post_interval_seconds)
+
+                    texts = text_fields[datestr]
+                    images = at_image_objects[datestr]
+                    print("Backfilling {0} on {1}.".format(datestr, app.platform_name))
+                    app.post(texts["post"],
+                             date_covered=datestr,
+                             image1=images.daily_melt_map,
+                             image1_alt=texts["daily_melt_map_alt"],
+                             image2=images.sum_map,
+                             image2_alt=texts["sum_map_alt"],
+                             image3=images.anomaly_map,
+                             image3_alt=texts["anomaly_map_alt"],
+                             image4=images.line_plot,
+                             image4_alt=texts["line_plot_alt"],
+                             reply_to_latest=True,
+                             sync_history=False)
+                    dates_posted.append(datestr)
+            finally:
+                # One thread sync for all the new posts, to fill in the rest of their post history.
+                if len(dates_posted) > 0:
+                    app.update_thread_data_file()
+
+            return dates_posted
+
+        responses = self._run_on_each_app(backfill_app)
+
+        for app, response in zip(self.apps, responses):
+            if isinstance(response, Exception):
+                print("ERROR backfilling {0}: {1}".format(app.platform_name, repr(response)))
+            elif response is not None:
+                print("{0}: backfilled {1} posts.".format(app.platform_name, len(response)))
+
+        # Upload the latest images to the git repository, once.
+        atgit = git_image_upload.ATGit()
+        atgit.upload_images(at_update_object, also_update_readme=True)
+
+        return responses
+
+
+def new_post_on_all_platforms(concurrent_platforms: bool = True,
+                              platform_names: list = None,
+                              backfill: bool = False):
+    atoday = AntTodaySocialApp(concurrent_platforms=concurrent_platforms,
+                               platform_names=platform_names)
     atoday.populate_and_connect()
-    responses = atoday.create_new_post()
+    if backfill:
+        responses = atoday.backfill_posts()
+    else:
+        responses = atoday.create_new_post()
     return responses
 
 
+def define_and_parse_args():
+    parser = argparse.ArgumentParser(description="Update the Antarctica Today data and post the new images on each "
+                                                 "social media platform.")
+    parser.add_argument("-serial", "-s", action="store_true", default=False,
+                        help="Log in and post on each platform one after the other, rather than all at once.")
+    parser.add_argument("-platforms", "-p", type=str, nargs="+", default=None,
+                        help="Only post on these platforms (e.g. 'bluesky'), whether or not they're enabled in "
+                             "platform_data.csv. Default: all the platforms enabled there.")
+    parser.add_argument("-backfill", "-b", action="store_true", default=False,
+                        help="Post every day of gathered plots that each platform hasn't covered yet (e.g. after "
+                             "missed runs), oldest first, rather than just the latest day.")
+
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    new_post_on_all_platforms()
+    args = define_and_parse_args()
+    new_post_on_all_platforms(concurrent_platforms=not args.serial,
+                              platform_names=args.platforms,
+                              backfill=args.backfill)
@@ -0,0 +1,40 @@
+"""atomic_file.py - Write files so that a crash never leaves one half-written.
+
+The new contents go to a temporary file in the same directory, which is renamed over the original only once it's
+completely written. Readers see either the old file or the new one, never a mix.
+
+Created by Mike MacFerrin
+"""
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_write(fname: str,
+                 mode: str = 'w',
+                 file_permissions: int = None,
+                 **open_kwargs):
+    """Open a temporary file for writing, and move it into place as fname when the "with" block finishes.
+
+    If the block raises an exception, the temporary file is removed and fname is left as it was.
+
+    :param fname: The file to write.
+    :param mode: The mode to open the file in, 'w' (text) or 'wb' (binary).
+    :param file_permissions: Permissions to give the new file, e.g. 0o644. If None, it's only readable and writable by
+        the current user (0o600).
+    :param open_kwargs: Any other arguments to open(), e.g. encoding="utf-8".
+    """
+    assert mode in ('w', 'wb')
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, **open_kwargs) as f:
+            yield f
+        if file_permissions is not None:
+            os.chmod(tmp_fname, file_permissions)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
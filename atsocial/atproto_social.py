@@ -1,15 +1,29 @@
 import argparse
 import atproto
+import atproto.exceptions
 import atproto.utils
 import re
 
 import anttoday_app_baseclass
+import media_upload_cache
+import session_store
 
 
 class AntTodayAppATProto(anttoday_app_baseclass.AntTodayAppBaseClass):
 
     def __init__(self):
         super(AntTodayAppATProto, self).__init__("bluesky")
+        # How many levels of replies to ask for in each get_post_thread call while walking the thread. The API allows
+        # up to 1000. Each request then covers this many posts of our thread instead of just one.
+        self.thread_fetch_depth = 100
+        # BlueSky rejects image blobs over 1,000,000 bytes, and displays images at up to 2000 pixels.
+        self.image_max_bytes = 1000000
+        self.image_max_dimension = 2000
+        # Blobs that aren't used in a post are cleaned up by the server after a while (on the order of an hour), so
+        # only reuse uploads for a bit less than that.
+        self.media_upload_cache = media_upload_cache.MediaUploadCache(self.platform_name, max_age_seconds=45 * 60)
+        # BlueSky allows thousands of new records an hour, so just leave a short gap between posts.
+        self.backfill_post_interval_seconds = 10
 
     def _login(self):
         # This should already be populated.
@@ -18,8 +32,29 @@ class AntTodayAppATProto(anttoday_app_baseclass.AntTodayAppBaseClass):
         assert hasattr(creds_obj, "username")
         assert hasattr(creds_obj, "app_password")
 
-        client = atproto.Client()
-        client.login(creds_obj.username, creds_obj.app_password)
+        # Keep the saved session up to date whenever the client creates or refreshes its tokens.
+        def new_client():
+            client = atproto.Client()
+            client.on_session_change(lambda event, session: session_store.save_session(
+                self.platform_name, {"username": creds_obj.username,
+                                     "session_string": client.export_session_string()}))
+            return client
+
+        # Reuse the last session if it's for the same account. createSession calls are heavily rate-limited, while a
+        # saved session's tokens just get refreshed as needed. Skip the profile lookup on login: nothing here uses it,
+        # and the client refreshes expired tokens itself (calling on_session_change) before its first real request.
+        saved_session = session_store.load_session(self.platform_name)
+        if saved_session is not None and saved_session.get("username") == creds_obj.username:
+            client = new_client()
+            try:
+                client.login(session_string=saved_session["session_string"], fetch_bsky_profile=False)
+                return client
+            except (atproto.exceptions.AtProtocolError, KeyError, ValueError):
+                print("Saved {0} session was rejected. Logging in again.".format(self.platform_name))
+                session_store.delete_session(self.platform_name)
+
+        client = new_client()
+        client.login(creds_obj.username, creds_obj.app_password, fetch_bsky_profile=False)
 
         return client
 
@@ -31,109 +66,213 @@ class AntTodayAppATProto(anttoday_app_baseclass.AntTodayAppBaseClass):
                                                                      "parent_height": 0})
         return search_results
 
+    def _fetch_thread_node(self, post_id: str, depth: int = None):
+        """Fetch a post and its replies, down to 'depth' levels (default self.thread_fetch_depth).
+
+        Returns the thread node, or None if the post can't be found."""
+        if depth is None:
+            depth = self.thread_fetch_depth
+
+        try:
+            search_results = self.session.app.bsky.feed.get_post_thread({"uri": post_id,
+                                                                         "depth": depth,
+                                                                         "parent_height": 0})
+        except atproto.exceptions.BadRequestError:
+            # Deleted (or otherwise unavailable) posts come back as a "NotFound" error.
+            return None
+
+        # Blocked or not-found posts don't have a "post" field.
+        if not hasattr(search_results.thread, "post"):
+            return None
+
+        return search_results.thread
+
+    def _select_reply_from_us(self, replies):
+        """Out of a list of reply thread nodes, pick the reply from us to follow down the thread. None if there isn't one."""
+        # If a reply is one that we authored, continue down that path. IMPORTANT: If we reply more than once to a
+        # single post, it will be important for us to put which post we want to follow as an entry in the post_history csv.
+        # Otherwise we could chase down the wrong reply branch.
+        replies_from_us = [reply for reply in (replies or []) if
+                           hasattr(reply, "post") and reply.post.author.handle == self.username]
+
+        if len(replies_from_us) == 0:
+            return None
+
+        # Find the reply, from us, that has the most replies after it. This is an imperfect measure but good for now.
+        # This should be unneeded logic since I don't plan to create multiple forks in the same thread with my own
+        # responses. I plan to just reply directly in the thread linearly.
+        most_populated_reply = replies_from_us[0]
+        for reply in replies_from_us[1:]:
+            if most_populated_reply.post.reply_count < reply.post.reply_count:
+                most_populated_reply = reply
+
+        return most_populated_reply
+
+    def _walk_thread_from(self, start_node) -> list:
+        """Starting at a thread node, follow our own replies down the thread and return the list of posts walked.
+
+        Each get_post_thread response holds self.thread_fetch_depth levels of replies, so we follow our reply chain
+        through the nested response and only make another request once we reach the bottom of it.
+        """
+        posts = [start_node.post]
+        node = start_node
+        # How many levels down the current response 'node' is.
+        level = 0
+
+        while True:
+            # At the bottom of this response the replies weren't sent to us. Fetch the next chunk of the thread from
+            # here, unless we know there aren't any replies at all.
+            if level >= self.thread_fetch_depth or node.replies is None:
+                if node.post.reply_count == 0:
+                    break
+
+                node = self._fetch_thread_node(node.post.uri)
+                if node is None:
+                    break
+                level = 0
+
+            next_reply = self._select_reply_from_us(node.replies)
+            if next_reply is None:
+                break
+
+            posts.append(next_reply.post)
+            node = next_reply
+            level += 1
+
+        return posts
+
+    def _is_valid_sync_anchor(self,
+                              anchor_post,
+                              top_post_id: str,
+                              anchor_reply_to_id) -> bool:
+        """Check that a post fetched from online still matches the post-history entry we're resuming a sync from."""
+        if anchor_post.author.handle != self.username:
+            return False
+
+        reply_ref = anchor_post.record.reply
+        # The anchor is never the top post, so it must be a reply within this thread...
+        if reply_ref is None or reply_ref.root.uri != top_post_id:
+            return False
+
+        # ...to the same parent post we have recorded for it.
+        if anchor_reply_to_id not in (None, '') and reply_ref.parent.uri != str(anchor_reply_to_id):
+            return False
+
+        return True
+
+    @staticmethod
+    def _post_to_postinfo(post) -> anttoday_app_baseclass.PostInfo:
+        """Convert an atproto post view into a PostInfo object."""
+        num_images = 0 if (post.embed is None or
+                           not hasattr(post.embed, "images") or
+                           len(post.embed.images) == 0) \
+            else len(post.embed.images)
+        return anttoday_app_baseclass.PostInfo(
+            post_id=post.uri,
+            reply_to_id=None if post.record.reply is None else post.record.reply.parent.uri,
+            timestamp=post.record.created_at,
+            text=post.record.text,
+            img1_path=post.embed.images[0].fullsize if (num_images >= 1) else None,
+            img1_alt=post.embed.images[0].alt if (num_images >= 1) else None,
+            img2_path=post.embed.images[1].fullsize if (num_images >= 2) else None,
+            img2_alt=post.embed.images[1].alt if (num_images >= 2) else None,
+            img3_path=post.embed.images[2].fullsize if (num_images >= 3) else None,
+            img3_alt=post.embed.images[2].alt if (num_images >= 3) else None,
+            img4_path=post.embed.images[3].fullsize if (num_images >= 4) else None,
+            img4_alt=post.embed.images[3].alt if (num_images >= 4) else None,
+            comments=None,
+        )
+
     def retrieve_post_thread(self,
                              top_post_id: str,
                              return_as_postinfo_objects: bool = True) -> list:
-        """Return a list of post attribute data of all self-response replies in a thread to the original post."""
-        current_post_id = top_post_id
-
-        # If we've already retrieved the whole damned thread this session, don't both repeating, just fetch it.
+        """Return a list of post attribute data of all self-response replies in a thread to the original post.
+
+        If incremental syncing is on, the walk resumes from the last synced post (see get_sync_anchor()), which is
+        also a cheap freshness check on the cached thread. The whole thread is only re-walked from the top if that
+        anchor post is gone or no longer matches what we have recorded. The PostInfo objects returned cover the whole
+        cached run of the thread, while the atproto post objects only cover the posts walked this session.
+        """
+        # If we've already retrieved the thread this session, don't both repeating, just fetch it.
         if self.thread_posts_cache is not None:
-            assert self.thread_posts_cache[0].uri == top_post_id
+            first_post = self.thread_posts_cache[0]
+            assert first_post.uri == top_post_id or first_post.record.reply.root.uri == top_post_id
             posts = self.thread_posts_cache
 
         else:
-            still_more_replies = True
-
-            posts = []
-
-            i = 1
-            while still_more_replies:
-                # Do a thread search on this post. This will give us the post information plus references to replies.
-                search_results = self.session.app.bsky.feed.get_post_thread({"uri": current_post_id,
-                                                                             "depth": 1,
-                                                                             "parent_height": 0})
-
-                post = search_results.thread.post
-                # print(i, post.uri, "by", post.author.handle + ":")
-                # print(post.record.created_at)
-                # if post.record.reply is not None:
-                #     print("in response to:", post.record.reply.parent.uri)
-                # print(post.record.text)
-                # if post.embed is None:
-                #     print("No images.")
-                # else:
-                #     print(len(post.embed.images), "images:")
-                #     for j, image in enumerate(post.embed.images):
-                #         print("  {0}: {1}h {2}w {3} '{4}'".format(j + 1,
-                #                                               image.aspect_ratio.height,
-                #                                               image.aspect_ratio.width,
-                #                                               image.fullsize,
-                #                                               image.alt))
-                #
-                # print()
-                posts.append(post)
-
-                # If a reply is one that we authored, continue down that path. IMPORTANT: If we reply more than once to a
-                # single post, it will be important for us to put which post we want to follow as an entry in the post_history csv.
-                # Otherwise we could chase down the wrong reply branch.
-                # print(self.username)
-                # print(search_results.thread.replies[0].post.author.handle)
-                replies_from_us = [reply.post for reply in search_results.thread.replies if
-                                   reply.post.author.handle == self.username]
-
-                if len(replies_from_us) == 0:
-                    still_more_replies = False
-                    continue
-
-                # Find the reply, from us, that has the most replies after it. This is an imperfect measure but good for now.
-                # This should be unneeded logic since I don't plan to create multiple forks in the same thread with my own
-                # responses. I plan to just reply directly in the thread linearly.
-                most_populated_reply = replies_from_us[0]
-                for reply in replies_from_us[1:]:
-                    if most_populated_reply.reply_count < reply.reply_count:
-                        most_populated_reply = reply
-
-                current_post_id = most_populated_reply.uri
-                still_more_replies = True
-
-                i += 1
+            anchor_id, anchor_reply_to_id = self.get_sync_anchor()
+            start_node = None
+
+            if anchor_id is not None:
+                start_node = self._fetch_thread_node(str(anchor_id))
+                if start_node is None or not self._is_valid_sync_anchor(start_node.post,
+                                                                         top_post_id,
+                                                                         anchor_reply_to_id):
+                    print("Last synced {0} post {1} no longer matches the thread online. Re-syncing the whole "
+                          "thread.".format(self.platform_name, anchor_id))
+                    start_node = None
+
+            if start_node is None:
+                start_node = self._fetch_thread_node(top_post_id)
+                assert start_node is not None
+
+            posts = self._walk_thread_from(start_node)
 
             # Save in the cache for later.
             self.thread_posts_cache = posts
 
-        if return_as_postinfo_objects:
-            # Turn all the posts into PostInfo objects.
-            postinfo_objects = [None] * len(posts)
-            for i, post in enumerate(posts):
-                post = posts[i]
-                num_images = 0 if (post.embed is None or
-                                   not hasattr(post.embed, "images") or
-                                   len(post.embed.images) == 0) \
-                    else len(post.embed.images)
-                post_obj = anttoday_app_baseclass.PostInfo(
-                    post_id=post.uri,
-                    reply_to_id=None if post.record.reply is None else post.record.reply.parent.uri,
-                    timestamp=post.record.created_at,
-                    text=post.record.text,
-                    img1_path=post.embed.images[0].fullsize if (num_images >= 1) else None,
-                    img1_alt=post.embed.images[0].alt if (num_images >= 1) else None,
-                    img2_path=post.embed.images[1].fullsize if (num_images >= 2) else None,
-                    img2_alt=post.embed.images[1].alt if (num_images >= 2) else None,
-                    img3_path=post.embed.images[2].fullsize if (num_images >= 3) else None,
-                    img3_alt=post.embed.images[2].alt if (num_images >= 3) else None,
-                    img4_path=post.embed.images[3].fullsize if (num_images >= 4) else None,
-                    img4_alt=post.embed.images[3].alt if (num_images >= 4) else None,
-                    comments=None,
-                )
-                postinfo_objects[i] = post_obj
+        # Keep the on-disk thread cache up to date with whatever we've walked.
+        postinfo_objects = self.update_thread_cache(top_post_id, [self._post_to_postinfo(post) for post in posts])
 
+        if return_as_postinfo_objects:
             return postinfo_objects
 
         else:
             # Otherwise, just return as the atproto post class objects.
             return posts
 
+    def _tail_index_entry(self, post) -> dict:
+        """Return a tail index entry for an atproto post view, with the strong refs (URI + CID) needed to reply to it."""
+        reply_ref = post.record.reply
+        return {"post_id": post.uri,
+                "cid": post.cid,
+                "root_id": post.uri if reply_ref is None else reply_ref.root.uri,
+                "root_cid": post.cid if reply_ref is None else reply_ref.root.cid}
+
+    @staticmethod
+    def _reply_ref_from_tail_entry(tail_entry: dict):
+        """Build the ReplyRef for replying to the post in a tail index entry: the strong refs (URI + CID) of that post
+        as the parent, and of the top post of its thread as the root."""
+        return atproto.models.AppBskyFeedPost.ReplyRef(
+            parent=atproto.models.ComAtprotoRepoStrongRef.Main(uri=tail_entry["post_id"], cid=tail_entry["cid"]),
+            root=atproto.models.ComAtprotoRepoStrongRef.Main(uri=tail_entry["root_id"], cid=tail_entry["root_cid"]))
+
+    def build_reply_ref(self):
+        """Build the ReplyRef for a new post replying to the latest post in our thread.
+
+        If the tail index was written recently, it's used as-is with no lookups at all. Otherwise the latest post is
+        found (usually with one lookup to confirm the tail index) and the refs are taken from that.
+        """
+        tail_entry = self.read_tail_index()
+        if tail_entry is None \
+                or not self.is_tail_index_fresh(tail_entry) \
+                or any(tail_entry.get(key) is None for key in ("post_id", "cid", "root_id", "root_cid")):
+            tail_entry = self._tail_index_entry(self.find_latest_thread_post())
+
+        return self._reply_ref_from_tail_entry(tail_entry)
+
+    def _confirm_tail_post(self, tail_entry: dict):
+        """Check, with a single get_post_thread call, that the post in the tail index is still there, unchanged, and
+        without any newer replies from us. Return its post view if so, otherwise None."""
+        node = self._fetch_thread_node(tail_entry["post_id"], depth=1)
+        if node is None or node.post.cid != tail_entry.get("cid"):
+            return None
+
+        if self._select_reply_from_us(node.replies) is not None:
+            return None
+
+        return node.post
+
     def _create_post(self,
                      text: str,
                      image1: str,
@@ -148,70 +287,36 @@ class AntTodayAppATProto(anttoday_app_baseclass.AntTodayAppBaseClass):
         """Create a post with the necessary data, fetch the latest reply, a post to the thread.
 
         Return the id of the new post."""
-        # Get the info of the latest post we shoudl be replying to.
+        # Get the info of the latest post we should be replying to.
         if reply_to_latest:
-            last_post_obj = self.find_latest_thread_post()
-
-            # print("last_post_obj", type(last_post_obj))
-            # print(last_post_obj)
-            # text = "  \n\n".join(["{0}: {1}".format(attr, getattr(last_post_obj, attr)) for attr in dir(last_post_obj) if attr[0] != "_"])
-            # print(text)
-            # parent_loc = text.lower().find("replyref=")
-            # print("\n\n===================\nreplyref= at:", parent_loc, "\n", text[max(0, parent_loc - 3000) : parent_loc + 150])
-
-            reply_obj = last_post_obj.record.reply
-            # Except, the last post in that thread was in response to the one before it. We want our post to be in
-            # response to the last post, so change the data of the 'parent' to point to the last post instead.
-            if reply_obj is None:
-                # If the last post was the first post of the thread, it has no "record.reply" object in it. So create
-                # one pointing to the top post.
-                # I'm having trouble coding up a valid ReplyRef object here by scratch because the atproto API is a PITA.
-                # So I'm just going to grab a one from online and change the parameters as needed.
-                # Just using one of my previous reply posts in a longer random thread, url here:
-                # https://bsky.app/profile/icesheetmike.bsky.social/post/3kgrpb7qb562h
-                # And then changing the reply_obj... .uri and .cid fields to make atproto happy with it..
-                random_reply_post = self.get_post_data(
-                    post_id="at://did:plc:iqcyflkt2gun674dnbssobt6/app.bsky.feed.post/3kgrpb7qb562h")
-
-                # This is where a valid ReplyRef object sits in that return object.
-                reply_obj = random_reply_post.thread.post.record.reply
-                # Change it to point to reply to the post I want it to reply to.
-                reply_obj.parent.uri = last_post_obj.uri
-                reply_obj.parent.cid = last_post_obj.cid
-
-                # This code is still broken, don't have the energy to debug. Why does atproto make this a royal PITA.
-                # reply_obj = last_post_obj
-                # (parent=last_post_obj,
-                #                                                    root=last_post_obj))
-                # reply_obj.parent = last_post_obj
-            else:
-                reply_obj.parent.uri = last_post_obj.uri
-                reply_obj.parent.cid = last_post_obj.cid
-
+            reply_obj = self.build_reply_ref()
         else:
-            # last_post_obj = None
             reply_obj = None
 
-        # print("LAST POST OBJ:")
-        # print(last_post_obj)
-        # text = "  \n\n".join(["{0}: {1}".format(attr, getattr(last_post_obj, attr)) for attr in dir(last_post_obj) if attr[0] != "_"])
-        # print(text)
-        # reply_ref_loc = text.lower().find("replyref")
-        # print("\n\n===================\nREPLY_REF AT:", reply_ref_loc, "\n", text[reply_ref_loc - 3000 : reply_ref_loc + 150])
-
-        image_objs = []
-        for (img_fn, img_alt) in [(image1, image1_alt),
-                                  (image2, image2_alt),
-                                  (image3, image3_alt),
-                                  (image4, image4_alt)]:
-            if img_fn is not None:
-                # Look at https://github.com/MarshalX/atproto/blob/main/atproto/xrpc_client/client/client.py reference.
-                # Use the code from "send_image" to make a post that sends multiple images. Same fuckin' code, they
-                # just didn't finish it. You can.
-                img_data = open(img_fn, 'rb').read()
+        def upload_image(img_fn, img_alt):
+            # Look at https://github.com/MarshalX/atproto/blob/main/atproto/xrpc_client/client/client.py reference.
+            # Use the code from "send_image" to make a post that sends multiple images. Same fuckin' code, they
+            # just didn't finish it. You can.
+            with open(img_fn, 'rb') as f:
+                img_data = f.read()
+
+            # If we've already uploaded these exact bytes recently (e.g. a post that failed after uploading), reuse
+            # that blob rather than sending it again.
+            img_key = media_upload_cache.media_key(img_data)
+            blob = self.media_upload_cache.get(img_key)
+            if blob is None:
                 upload = self.session.com.atproto.repo.upload_blob(img_data)
-                image_obj = atproto.models.AppBskyEmbedImages.Image(alt=img_alt, image=upload.blob)
-                image_objs.append(image_obj)
+                blob = upload.blob.model_dump(mode="json", by_alias=True)
+                self.media_upload_cache.put(img_key, blob)
+
+            return atproto.models.AppBskyEmbedImages.Image(alt=img_alt, image=blob)
+
+        # Upload all the images at once. If any of them fail, this raises before we post anything.
+        image_objs = self.upload_images([(image1, image1_alt),
+                                         (image2, image2_alt),
+                                         (image3, image3_alt),
+                                         (image4, image4_alt)],
+                                        upload_image)
 
         # Build embed objects for images.
         if len(image_objs) > 0:
@@ -223,6 +328,13 @@ class AntTodayAppATProto(anttoday_app_baseclass.AntTodayAppBaseClass):
                                           reply_to=reply_obj,
                                           embed=embeds)
 
+        # The new post is now the tail of the thread.
+        if reply_to_latest:
+            self.update_tail_index({"post_id": response.uri,
+                                    "cid": response.cid,
+                                    "root_id": response.uri if reply_obj is None else reply_obj.root.uri,
+                                    "root_cid": response.cid if reply_obj is None else reply_obj.root.cid})
+
         # print("RESPONSE:")
         # print(response)
         # print("RESPONSE FIELDS:")
@@ -245,6 +357,9 @@ def define_and_parse_args():
     parser.add_argument("-comment", "-c", type=str, default="",
                         help="Add a comment into the 'comments' field in the last post. These comments are not seen "
                              "with the posts, they are simply for our own benefit.")
+    parser.add_argument("-full_sync", "-f", action="store_true", default=False,
+                        help="Re-walk the whole thread from the top post, rather than resuming from the last post "
+                             "already synced in the thread cache or post history.")
 
     return parser.parse_args()
 
@@ -257,9 +372,11 @@ if __name__ == "__main__":
             "ERROR: The argument -date must be in a YYYY.MM.DD format, which '{0}' is not. Exiting.".format(args.date))
 
     app = AntTodayAppATProto()
+    app.incremental_sync = not args.full_sync
     app.open_and_populate()
-    df = app.update_thread_data_file(new_date_covered=None if (args.date == "") else args.date,
-                                     new_comment=None if (args.comment == "") else args.comment)
+    app.update_thread_data_file(new_date_covered=None if (args.date == "") else args.date,
+                                new_comment=None if (args.comment == "") else args.comment)
+    df = app.post_history_df
 
     print("Last post info:")
     colnames = list(df.columns)
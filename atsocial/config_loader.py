@@ -0,0 +1,63 @@
+"""config_loader.py - Read the small configuration CSVs without pandas.
+
+platform_data.csv, the credentials files, and text_templates.csv are all just a handful of rows. Reading them with the
+csv module avoids importing pandas (a large share of each run's startup time) just to get at a few values. Parsed
+files are cached in memory, keyed by their modification time and size, so repeated reads (e.g. every platform reading
+platform_data.csv) only parse each file once, and a file that changes on disk is read again.
+
+Rows whose first cell starts with "#" are comments and are skipped, as are blank rows. All values are strings.
+
+Created by Mike MacFerrin
+"""
+
+import csv
+import os
+import threading
+
+# {absolute filename: ((mtime_ns, size), list of rows)}
+_rows_cache = {}
+# The platforms may read these files from their own threads at the same time.
+_rows_cache_lock = threading.Lock()
+
+
+def _parse_rows(csv_fname: str) -> list:
+    with open(csv_fname, 'r', newline='', encoding='utf-8') as f:
+        return [row for row in csv.reader(f)
+                if len(row) > 0 and any(cell != "" for cell in row) and not row[0].lstrip().startswith("#")]
+
+
+def read_rows(csv_fname: str) -> list:
+    """Return the rows of a CSV file as lists of strings, skipping comment and blank rows."""
+    csv_fname = os.path.abspath(csv_fname)
+    stat = os.stat(csv_fname)
+    file_version = (stat.st_mtime_ns, stat.st_size)
+
+    with _rows_cache_lock:
+        cached = _rows_cache.get(csv_fname)
+        if cached is None or cached[0] != file_version:
+            cached = (file_version, _parse_rows(csv_fname))
+            _rows_cache[csv_fname] = cached
+
+    # Hand back copies, so callers can't change what's in the cache.
+    return [list(row) for row in cached[1]]
+
+
+def read_table(csv_fname: str) -> list:
+    """Read a CSV file with a header row into a list of dictionaries, one per row. Missing values are empty strings."""
+    rows = read_rows(csv_fname)
+    if len(rows) == 0:
+        return []
+
+    header = rows[0]
+    return [dict(zip(header, row + [""] * (len(header) - len(row)))) for row in rows[1:]]
+
+
+def read_key_values(csv_fname: str) -> list:
+    """Read a 2-column "name, value" CSV file (with no header row) into a list of (name, value) pairs."""
+    pairs = []
+    for row in read_rows(csv_fname):
+        assert len(row) >= 2 and all(cell == "" for cell in row[2:]), \
+            "Expected 2 columns in {0}, got {1}".format(os.path.basename(csv_fname), row)
+        pairs.append((row[0], row[1]))
+
+    return pairs
@@ -0,0 +1,163 @@
+"""file_staging.py - Put files in place without copying bytes that are already there.
+
+Staging a file to a destination goes through these steps, cheapest first:
+  1. If the destination already has the same contents (same size and SHA-256 hash), leave it alone.
+  2. If another file nearby (e.g. yesterday's version of the image, under its old name) has the same contents, rename
+     it to the destination.
+  3. Otherwise place the new file with a reflink (a copy-on-write clone, on filesystems like btrfs and XFS that support
+     it), or a hardlink if it's on the same filesystem, and fall back to a plain copy only if neither works.
+     Hardlinks can be turned off (link=False) where the destination must not share its bytes with the source, e.g. in a
+     git working tree, where rewriting the source in place would silently change the committed file too.
+
+A StagingReport adds up how many bytes were actually copied and how many were avoided.
+
+Created by Mike MacFerrin
+"""
+
+import hashlib
+import os
+import shutil
+import stat
+
+import atomic_file
+
+try:
+    import fcntl
+except ImportError:
+    # No reflinks on Windows.
+    fcntl = None
+
+# The Linux FICLONE ioctl, which makes the destination file share the source file's data blocks.
+FICLONE = 0x40049409
+
+
+def sha256_file(fname: str) -> str:
+    """Return the hex SHA-256 hash of a file's contents."""
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class StagingReport:
+    """A running tally of what staging did with each file."""
+
+    def __init__(self):
+        # Each entry is (destination, method, number of bytes).
+        self.entries = []
+
+    def add(self, dst: str, method: str, nbytes: int):
+        self.entries.append((dst, method, nbytes))
+
+    @property
+    def bytes_copied(self) -> int:
+        return sum(nbytes for (_, method, nbytes) in self.entries if method == "copy")
+
+    @property
+    def bytes_avoided(self) -> int:
+        return sum(nbytes for (_, method, nbytes) in self.entries if method != "copy")
+
+    @property
+    def changed_files(self) -> list:
+        """The destinations that got new contents (everything but the ones skipped as unchanged)."""
+        return [dst for (dst, method, _) in self.entries if method != "unchanged"]
+
+    def summary(self) -> str:
+        methods = {}
+        for (_, method, _) in self.entries:
+            methods[method] = methods.get(method, 0) + 1
+        return "Staged {0} file(s) ({1}): {2:,} bytes copied, {3:,} bytes avoided.".format(
+            len(self.entries),
+            ", ".join("{0} {1}".format(n, method) for (method, n) in sorted(methods.items())),
+            self.bytes_copied,
+            self.bytes_avoided)
+
+
+def _same_contents(fname: str, size: int, sha256: str) -> bool:
+    return os.path.exists(fname) and os.path.getsize(fname) == size and sha256_file(fname) == sha256
+
+
+def _reflink(f_src, f_dst):
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform.")
+    fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+
+def _hardlink(src: str, dst: str):
+    # os.link() won't replace an existing file, so link to a temporary name next to dst and rename that over it.
+    tmp_fname = "{0}.{1}.tmp".format(dst, os.getpid())
+    os.link(src, tmp_fname)
+    try:
+        os.replace(tmp_fname, dst)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+
+
+def place_file(src: str, dst: str, link: bool = True) -> str:
+    """Put a copy of src at dst (replacing anything already there), as cheaply as the filesystem allows.
+
+    If link is False, dst is never hardlinked to src (only reflinked or copied).
+    Returns the method that worked: "reflink", "hardlink" or "copy"."""
+    # Reflinks and copies are written with atomic_write, so dst is never left half-written. If the reflink fails, its
+    # temporary file is thrown away and dst is left as it was.
+    file_permissions = stat.S_IMODE(os.stat(src).st_mode)
+    with open(src, 'rb') as f_src:
+        try:
+            with atomic_file.atomic_write(dst, 'wb', file_permissions=file_permissions) as f_dst:
+                _reflink(f_src, f_dst)
+            return "reflink"
+        except OSError:
+            pass
+
+        if link:
+            try:
+                _hardlink(src, dst)
+                return "hardlink"
+            except OSError:
+                pass
+
+        with atomic_file.atomic_write(dst, 'wb', file_permissions=file_permissions) as f_dst:
+            shutil.copyfileobj(f_src, f_dst)
+        return "copy"
+
+
+def stage_file(src: str,
+               dst: str,
+               report: StagingReport = None,
+               src_sha256: str = None,
+               reuse_candidates: list = (),
+               link: bool = True) -> str:
+    """Make dst have the same contents as src, skipping or renaming instead of copying wherever possible.
+
+    :param src: The file to stage.
+    :param dst: Where to put it.
+    :param report: If given, record what was done in this StagingReport.
+    :param src_sha256: The SHA-256 hash of src, if it's already known (e.g. from the plot catalog).
+    :param reuse_candidates: Other files (e.g. the outdated version of dst under an older name) that can be renamed to dst
+        if they already have the same contents as src. Any that do are consumed.
+    :param link: If False, never hardlink dst to src (see place_file).
+    :return: What was done: "unchanged", "renamed", "reflink", "hardlink" or "copy".
+    """
+    size = os.path.getsize(src)
+    if src_sha256 is None:
+        src_sha256 = sha256_file(src)
+
+    if _same_contents(dst, size, src_sha256):
+        method = "unchanged"
+    else:
+        method = None
+        for candidate in reuse_candidates:
+            if os.path.abspath(candidate) != os.path.abspath(dst) and _same_contents(candidate, size, src_sha256):
+                os.replace(candidate, dst)
+                method = "renamed"
+                break
+
+        if method is None:
+            method = place_file(src, dst, link=link)
+
+    if report is not None:
+        report.add(dst, method, size)
+
+    return method
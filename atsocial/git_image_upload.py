@@ -1,17 +1,43 @@
-"""Code for uploading data (namely images) to the Git repository for the project."""
+"""Code for uploading data (namely images) to the Git repository for the project.
 
+Images can be published in one of two modes (see image_mode_default below):
+  "repo":  The images are committed into the images/ directory of the main branch, as they always have been. Simple, but
+           every day's images stay in the repository's history forever, so it grows by ~1.4 MB every day of the season.
+  "store": The images are kept on a separate "image store" branch with no history. Each update replaces that branch
+           with a single new parentless commit holding just the latest images (named by their content hash), and
+           force-pushes it. The main branch only gets a small images/manifest.json and the most_recent_date.txt file,
+           and the README's images point at the store branch's raw files. Old images drop out of the repository when
+           the remote garbage-collects, so a clone stays about the same size however many seasons go by.
+"""
+
+import json
 import os
 import re
-import shutil
 import subprocess
 import time
 
 import add_date_to_readme
+import atomic_file
+import file_staging
 import update_antarctica_today
 
 # This should point to the base directory of this repo. In this case, one parent directory up.
 gitrepo_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
+# How the images are published, "repo" or "store". See the notes at the top of this file.
+image_mode_default = "repo"
+# The branch that holds the images in "store" mode.
+image_store_branch_default = "images-store"
+
+# The start of each image's file name in the images/ directory (and on the store branch), by role.
+image_prefixes = {"daily_melt_map": "R0_daily_",
+                  "sum_map": "R0_sum_",
+                  "anomaly_map": "R0_anomaly_",
+                  "line_plot": "R0_line_plot_"}
+
+# Bump this whenever the format of images/manifest.json changes.
+MANIFEST_VERSION = 1
+
 
 class ATGit:
     """Sipmle class for handling the antarctica_today_social Git repository.
@@ -19,24 +45,279 @@ class ATGit:
     Namely, uploading image files to the 'images' directory.
     Most actual Git development is handled externally (not using this code-base)."""
 
-    def __init__(self):
-        self.repodir = gitrepo_dir
+    def __init__(self,
+                 repodir: str = gitrepo_dir,
+                 image_mode: str = image_mode_default,
+                 image_store_branch: str = image_store_branch_default,
+                 image_store_url_base: str = None):
+        """
+        :param repodir: The base directory of the repository.
+        :param image_mode: "repo" or "store". See the notes at the top of this file.
+        :param image_store_branch: The branch to keep the images on in "store" mode.
+        :param image_store_url_base: The URL that the store branch's files are served from, ending with a "/". If None,
+            it's worked out from the "origin" remote if that's on GitHub.
+        """
+        assert image_mode in ("repo", "store"), "Unknown image mode '{0}'.".format(image_mode)
+        self.repodir = repodir
         self.img_dir = os.path.join(self.repodir, "images")
+        # The pages that show the images and date. Add any others (e.g. a web page index.html) to this list.
+        self.readme_fnames = [os.path.join(self.repodir, "README.md")]
+        self.manifest_fname = os.path.join(self.img_dir, "manifest.json")
         self.is_local_current = False
         self.git_cmd = "/usr/bin/git"
+        # How many times to try a push, and how long to wait before the first retry (doubled after each failure).
+        self.push_attempts = 4
+        self.push_retry_seconds = 2
+        self.image_mode = image_mode
+        self.image_store_branch = image_store_branch
+        self.image_store_remote = "origin"
+        self.image_store_url_base = image_store_url_base
+
+    def run_git(self, *args, input_text: str = None, ok_returncodes: tuple = (0,)) -> subprocess.CompletedProcess:
+        """Run one git command in the repo, capturing its output. Print any errors.
+
+        Return codes in ok_returncodes aren't errors (e.g. "git diff --quiet" returns 1 if there are differences)."""
+        print(">", "git", " ".join(args))
+        result = subprocess.run([self.git_cmd] + list(args), cwd=self.repodir, capture_output=True, text=True,
+                                input=input_text)
+        if result.returncode not in ok_returncodes:
+            print((result.stderr or result.stdout).rstrip())
+        return result
+
+    def push(self, *push_args) -> bool:
+        """Push to the remote (with any extra arguments to "git push"), retrying with a growing wait if it fails.
+        Return True if it went through."""
+        wait_seconds = self.push_retry_seconds
+        for attempt in range(1, self.push_attempts + 1):
+            if self.run_git("push", *push_args).returncode == 0:
+                return True
+
+            if attempt < self.push_attempts:
+                print("Push attempt {0} of {1} failed. Retrying in {2} s.".format(attempt, self.push_attempts,
+                                                                                  wait_seconds))
+                time.sleep(wait_seconds)
+                wait_seconds *= 2
+
+        print("ERROR: Could not push to the remote after {0} attempts.".format(self.push_attempts))
+        return False
+
+    def publish(self, pathspecs: list, message: str) -> bool:
+        """Stage every change (additions, modifications and removals) under the given paths in one "git add -A",
+        commit it, and push it. Return True if a new commit was pushed.
+
+        If there's nothing new to commit but an earlier commit never made it to the remote (e.g. its push failed), that
+        commit is pushed instead."""
+        start = time.perf_counter()
+
+        if self.run_git("add", "-A", "--", *pathspecs).returncode != 0:
+            return False
+
+        # Ask git whether anything was staged (return code 1 if so), rather than reading its (localized) messages.
+        diff_result = self.run_git("diff", "--cached", "--quiet", "--", *pathspecs, ok_returncodes=(0, 1))
+        if diff_result.returncode not in (0, 1):
+            return False
 
-    def pull(self):
-        print("> git pull")
-        subprocess.run([self.git_cmd, "pull"], cwd=self.repodir)
+        if diff_result.returncode == 1:
+            if self.run_git("commit", "-m", message, "--", *pathspecs).returncode != 0:
+                return False
+        else:
+            print("Nothing new to commit.")
+
+            ahead_result = self.run_git("rev-list", "--count", "@{u}..HEAD")
+            if ahead_result.returncode != 0 or int(ahead_result.stdout.strip()) == 0:
+                return False
+            print("{0} earlier commit(s) not pushed yet.".format(ahead_result.stdout.strip()))
+
+        pushed = self.push()
+        if pushed:
+            print("Published in {0:.2f} s.".format(time.perf_counter() - start))
+        return pushed
+
+    def pull(self) -> bool:
+        """Make sure the local branch is current with its upstream branch on the remote.
+
+        Only the remote's ref is queried ("git ls-remote") and compared to the local head. Objects are only fetched, and
+        the branch fast-forwarded, if the two differ. Returns True (and sets is_local_current) if the local branch is
+        current afterward."""
+        start = time.perf_counter()
+
+        # One local call gets the current branch's commit and where its upstream lives.
+        refs_result = self.run_git("for-each-ref",
+                                   "--format=%(HEAD) %(objectname) %(upstream:remotename) %(upstream:remoteref)",
+                                   "refs/heads/")
+        if refs_result.returncode != 0:
+            return False
+        current_branch = [line.split()[1:] for line in refs_result.stdout.splitlines() if line.startswith("*")]
+        if len(current_branch) == 0 or len(current_branch[0]) < 3:
+            print("ERROR: The local repo is not on a branch with an upstream branch to pull from.")
+            return False
+        local_head, remote_name, remote_ref = current_branch[0]
+        upstream_name = remote_name + "/" + remote_ref.replace("refs/heads/", "", 1)
+
+        remote_result = self.run_git("ls-remote", remote_name, remote_ref)
+        if remote_result.returncode != 0:
+            return False
+        remote_heads = [line.split()[0] for line in remote_result.stdout.splitlines() if line.split()[1] == remote_ref]
+        if len(remote_heads) == 0:
+            print("ERROR: Branch {0} was not found on remote '{1}'.".format(remote_ref, remote_name))
+            return False
+
+        if remote_heads[0] != local_head:
+            # The remote moved (or we have commits it doesn't). Fetch and fast-forward. If our branch is just ahead of
+            # the remote, the merge is a no-op.
+            if self.run_git("fetch", remote_name).returncode != 0 \
+                    or self.run_git("merge", "--ff-only", "@{u}").returncode != 0:
+                print("ERROR: Could not fast-forward the local repo to {0}.".format(upstream_name))
+                return False
+
+        print("Local repo is current with {0} ({1:.2f} s).".format(upstream_name, time.perf_counter() - start))
         self.is_local_current = True
+        return True
+
+    def stage_images_in_repo(self,
+                             atimages_obj: update_antarctica_today.AntarcticaTodayImages,
+                             old_repo_images: dict) -> dict:
+        """In "repo" mode, put the new images in the images/ directory in place of the old ones.
+
+        Returns {role: README image src} for the new images."""
+        print("Staging images and datestr to /images/ dir.")
+        # Replace the repo images with the updated verseions. Images whose bytes haven't changed are skipped (or just
+        # renamed from the old date's name), and changed ones are reflinked rather than copied where possible. No
+        # hardlinks: a repo image sharing its bytes with the source would change along with it if the source were
+        # rewritten in place, behind git's back.
+        report = file_staging.StagingReport()
+        image_srcs = {}
+        for role, prefix in image_prefixes.items():
+            repo_img_name = "{0}{1}.png".format(prefix, atimages_obj.datestr)
+            repo_img = os.path.join(self.img_dir, repo_img_name)
+            old_repo_img = old_repo_images[role]
+            file_staging.stage_file(getattr(atimages_obj, role), repo_img, report,
+                                    src_sha256=atimages_obj.image_hashes.get(role),
+                                    reuse_candidates=[] if old_repo_img is None else [old_repo_img],
+                                    link=False)
+            # Remove the old image if it wasn't renamed. "git add -A" picks up the removal.
+            if old_repo_img is not None and old_repo_img != repo_img and os.path.exists(old_repo_img):
+                os.remove(old_repo_img)
+            image_srcs[role] = "./images/" + repo_img_name
+        print(report.summary())
+
+        # If we're switching over from "store" mode, the manifest no longer applies.
+        if os.path.exists(self.manifest_fname):
+            os.remove(self.manifest_fname)
+
+        return image_srcs
+
+    def get_image_store_url_base(self) -> str:
+        """The URL that files on the image store branch are served from. Worked out from the "origin" remote's URL if
+        it's on GitHub, unless it was given explicitly."""
+        if self.image_store_url_base is None:
+            result = self.run_git("remote", "get-url", self.image_store_remote)
+            url_match = re.search(r"github\.com[:/]([^/]+)/(.+?)(\.git)?/?\Z", result.stdout.strip())
+            assert result.returncode == 0 and url_match is not None, \
+                "Can't work out the image store's URL from remote '{0}'. Give ATGit an image_store_url_base.".format(
+                    self.image_store_remote)
+            self.image_store_url_base = "https://raw.githubusercontent.com/{0}/{1}/{2}/".format(
+                url_match.group(1), url_match.group(2), self.image_store_branch)
+
+        return self.image_store_url_base
+
+    def read_manifest(self) -> dict:
+        """Read images/manifest.json, or return None if there isn't one (or it's an older format)."""
+        if not os.path.exists(self.manifest_fname):
+            return None
+        with open(self.manifest_fname, 'r') as f:
+            manifest = json.load(f)
+        return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+    def write_manifest(self, manifest: dict):
+        with atomic_file.atomic_write(self.manifest_fname, file_permissions=0o644) as f:
+            json.dump(manifest, f, indent=2)
+            f.write("\n")
+
+    def publish_images_to_store(self,
+                                atimages_obj: update_antarctica_today.AntarcticaTodayImages,
+                                old_repo_images: dict) -> dict:
+        """In "store" mode, replace the image store branch with a single commit holding just the new images, push it,
+        and write images/manifest.json to point at them.
+
+        Images are named by their content hash (e.g. "R0_daily_2024.04.24_<16 hex digits>.png"), so a URL always
+        refers to the same image and a re-processed image gets a new URL. The date stays in the names so the README's
+        "contains_short_date" tags still find it.
+
+        Returns {role: README image src} for the new images, or None if they couldn't be pushed."""
+        images = {}
+        for role, prefix in image_prefixes.items():
+            new_img = getattr(atimages_obj, role)
+            sha256 = atimages_obj.image_hashes.get(role) or file_staging.sha256_file(new_img)
+            images[role] = {"file": "{0}{1}_{2}.png".format(prefix, atimages_obj.datestr, sha256[:16]),
+                            "sha256": sha256,
+                            "size": os.path.getsize(new_img)}
+
+        url_base = self.get_image_store_url_base()
+        manifest = self.read_manifest()
+        if manifest is not None and manifest["date"] == atimages_obj.datestr and manifest["images"] == images \
+                and manifest["url_base"] == url_base:
+            print("Images for {0} are already in the image store.".format(atimages_obj.datestr))
+        else:
+            start = time.perf_counter()
+            # Write the images into git's object database, build a tree of just them, and commit that tree with no
+            # parent. Nothing is checked out, so the working tree isn't touched.
+            roles = list(image_prefixes.keys())
+            hash_result = self.run_git("hash-object", "-w", "--stdin-paths",
+                                       input_text="".join(os.path.abspath(getattr(atimages_obj, role)) + "\n"
+                                                          for role in roles))
+            if hash_result.returncode != 0:
+                return None
+            blob_ids = hash_result.stdout.split()
+
+            tree_result = self.run_git("mktree", input_text="".join(
+                "100644 blob {0}\t{1}\n".format(blob_id, images[role]["file"]) for (role, blob_id) in
+                zip(roles, blob_ids)))
+            if tree_result.returncode != 0:
+                return None
+
+            commit_result = self.run_git("commit-tree", tree_result.stdout.strip(),
+                                         "-m", "Images for {0}.".format(atimages_obj.datestr))
+            if commit_result.returncode != 0:
+                return None
+            store_commit = commit_result.stdout.strip()
+
+            # Keep a local branch pointing at it too, and replace the remote's store branch with it. The previous store
+            # commits are left with nothing pointing at them, so they (and their images) get garbage-collected.
+            store_ref = "refs/heads/" + self.image_store_branch
+            if self.run_git("update-ref", store_ref, store_commit).returncode != 0 \
+                    or not self.push("--force", self.image_store_remote, "{0}:{0}".format(store_ref)):
+                return None
+            print("Pushed images to branch {0} in {1:.2f} s.".format(self.image_store_branch,
+                                                                     time.perf_counter() - start))
+
+            manifest = {"version": MANIFEST_VERSION,
+                        "date": atimages_obj.datestr,
+                        "store_branch": self.image_store_branch,
+                        "store_commit": store_commit,
+                        "url_base": url_base,
+                        "images": images}
+            self.write_manifest(manifest)
+
+        # The images don't live on the main branch in this mode. "git add -A" picks up the removals.
+        for old_repo_img in old_repo_images.values():
+            if old_repo_img is not None:
+                os.remove(old_repo_img)
+
+        return {role: url_base + images[role]["file"] for role in image_prefixes}
 
     def upload_images(self,
                       atimages_obj: update_antarctica_today.AntarcticaTodayImages,
-                      also_update_readme: bool = True):
+                      also_update_readme: bool = True) -> bool:
+        """Replace the images in the repo's images/ directory with a new day's images, and publish them.
+
+        Returns True if new images were committed and pushed."""
+        published = False
 
         # First, make sure our present repo is synced with the main branch.
-        if not self.is_local_current:
-            self.pull()
+        if not self.is_local_current and not self.pull():
+            print("Not uploading images, the local Git repo could not be brought up to date.")
+            return published
 
         # The text file containing the "most recent date" updated in the repository.
         date_txtfile = os.path.join(self.img_dir, "most_recent_date.txt")
@@ -50,90 +331,52 @@ class ATGit:
         # Make sure that's the right date format too.
         assert re.search(r"\A\d{4}\.\d{2}\.\d{2}\Z", atimages_datestr) is not None
 
-        # If the repo has an equal-or-later date than what we have here, then do nothing.
+        # If the repo has a later date than what we have here, then do nothing. If it has the same date, the images are
+        # still staged below, but only ones whose contents changed (e.g. re-processed data) get updated.
         # Since they're both confirmed to be in a 'YYYY.MM.DD' format, a sipmle string compare will do.
-        if local_repo_date_str >= atimages_datestr:
+        if local_repo_date_str > atimages_datestr:
             print(f"Date {local_repo_date_str} in local Git repo "
-                  "does not need to be updated with new images dated {atimages_datestr}")
+                  f"does not need to be updated with new images dated {atimages_datestr}")
         else:
-            # Get all the png files currently in the images/ dir.
-            png_files = [os.path.join(self.img_dir, fn) for fn in os.listdir(self.img_dir) if
-                         os.path.splitext(fn)[1] == ".png"]
-
-            # If the date in the repo is outdated, then we can update the text file and images.
-            repo_image_daily_old = [png for png in png_files if os.path.basename(png).find("R0_daily_") > -1][0]
-            repo_image_sum_old = [png for png in png_files if os.path.basename(png).find("R0_sum_") > -1][0]
-            repo_image_anomaly_old = [png for png in png_files if os.path.basename(png).find("R0_anomaly_") > -1][0]
-            repo_image_line_plot_old = [png for png in png_files if os.path.basename(png).find("R0_line_plot_") > -1][0]
-
-            # Remove all the old images.
-            # NEVER MIND. The "git rm" commands below will do this.
-            # os.remove(repo_image_daily_old)
-            # os.remove(repo_image_sum_old)
-            # os.remove(repo_image_anomaly_old)
-            # os.remove(repo_image_line_plot_old)
-
             # Quick sanity check to make sure the incoming images exist on disk to copy over.
-            assert os.path.exists(atimages_obj.daily_melt_map)
-            assert os.path.exists(atimages_obj.sum_map)
-            assert os.path.exists(atimages_obj.anomaly_map)
-            assert os.path.exists(atimages_obj.line_plot)
-
-            # Get the names of the new images, with the new datestring in there.
-            repo_image_daily_new = os.path.join(self.img_dir, "R0_daily_{0}.png".format(atimages_datestr))
-            repo_image_sum_new = os.path.join(self.img_dir, "R0_sum_{0}.png".format(atimages_datestr))
-            repo_image_anomaly_new = os.path.join(self.img_dir, "R0_anomaly_{0}.png".format(atimages_datestr))
-            repo_image_line_plot_new = os.path.join(self.img_dir, "R0_line_plot_{0}.png".format(atimages_datestr))
-
-            print("Copying images and datestr to /images/ dir.")
-            # First, overwrite the text file.
-            open(date_txtfile, 'w').write(atimages_datestr)
-
-            # Replace the repo images with the updated verseions.
-            for new_img, repo_img in [(atimages_obj.daily_melt_map, repo_image_daily_new),
-                                      (atimages_obj.sum_map, repo_image_sum_new),
-                                      (atimages_obj.anomaly_map, repo_image_anomaly_new),
-                                      (atimages_obj.line_plot, repo_image_line_plot_new)]:
-                # Copy over the new image
-                shutil.copyfile(new_img, repo_img)
-
-            # Now that the files have been copied.
-            # Update the readme with the new dates in it.
+            new_images = {role: getattr(atimages_obj, role) for role in image_prefixes}
+            for new_img in new_images.values():
+                assert os.path.exists(new_img)
+
+            # The images currently in the images/ dir, by role (None if there isn't one).
+            png_files = [fn for fn in os.listdir(self.img_dir) if os.path.splitext(fn)[1] == ".png"]
+            old_repo_images = {}
+            for role, prefix in image_prefixes.items():
+                matches = [os.path.join(self.img_dir, fn) for fn in png_files if fn.startswith(prefix)]
+                old_repo_images[role] = matches[0] if len(matches) > 0 else None
+
+            if self.image_mode == "store":
+                image_srcs = self.publish_images_to_store(atimages_obj, old_repo_images)
+            else:
+                image_srcs = self.stage_images_in_repo(atimages_obj, old_repo_images)
+            if image_srcs is None:
+                return published
+
+            # Then overwrite the text file.
+            if local_repo_date_str != atimages_datestr:
+                with open(date_txtfile, 'w') as f:
+                    f.write(atimages_datestr)
+
+            # Now that the files have been staged.
+            # Update the readme with the new dates and image locations in it.
             if also_update_readme:
-                add_date_to_readme.substitute_date_in_readme()
-
-            # Now, check in all the new files with Git.
-            # Then five or six add calls to add the new files, one commit, and one push up to the repository.
-            # If the README.md hasn't been changed, then the "git add README.md" command won't do anything at all.
-            git_cmd = self.git_cmd
-            git_args = [[git_cmd, "rm", "images/" + os.path.basename(repo_image_daily_old)],
-                        [git_cmd, "rm", "images/" + os.path.basename(repo_image_sum_old)],
-                        [git_cmd, "rm", "images/" + os.path.basename(repo_image_anomaly_old)],
-                        [git_cmd, "rm", "images/" + os.path.basename(repo_image_line_plot_old)],
-                        [git_cmd, "add", "images/most_recent_date.txt"],
-                        [git_cmd, "add", "images/" + os.path.basename(repo_image_daily_new)],
-                        [git_cmd, "add", "images/" + os.path.basename(repo_image_sum_new)],
-                        [git_cmd, "add", "images/" + os.path.basename(repo_image_anomaly_new)],
-                        [git_cmd, "add", "images/" + os.path.basename(repo_image_line_plot_new)],
-                        [git_cmd, "add", "README.md"],
-                        [git_cmd, "commit", "-m", '"Uploading most recent images for {0}."'.format(atimages_datestr)],
-                        [git_cmd, "push"],
-                        ]
-
-            # Run through and execute each command.
-            for arglist in git_args:
-                print(">", " ".join(arglist))
-
-                # The "push" commands don't seem to be working.
-                # Wait 5s after the commit before trying to push the code, perhaps that would help (not exactly sure here).
-                # If this doesn't work, I'll try something else.
-                # I haven't yet taken the time to fully debug what's going on here.
-                if arglist[1] == "push":
-                    time.sleep(5)
-
-                subprocess.run(arglist, cwd=self.repodir)
-
-        return
+                add_date_to_readme.render_files(self.readme_fnames, atimages_datestr,
+                                                image_srcs={image_prefixes[role]: src for (role, src) in
+                                                            image_srcs.items()})
+
+            # Now, check in all the changes with Git: one "add -A" for the whole images/ directory and the README (which
+            # picks up the removed images too), one commit, and one push. Git has the last word on whether anything
+            # changed.
+            published = self.publish(["images"] + [os.path.relpath(fname, self.repodir)
+                                                   for fname in self.readme_fnames],
+                                     "Uploading most recent images for {0}.".format(atimages_datestr))
+
+        return published
 
 
 if __name__ == "__main__":
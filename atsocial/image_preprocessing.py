@@ -0,0 +1,149 @@
+"""Code for fitting the Antarctica Today images into each platform's image size limits before uploading them.
+
+Every image is first re-saved as a losslessly-optimized PNG (keeping the original if that's no smaller). Only if it's
+still over the platform's byte budget is it quantized to a 256-color palette, and then scaled down until it fits.
+Images larger than the platform's maximum dimension are scaled down first.
+
+Results are cached in /data/image_cache/, keyed by a hash of the original image's bytes and the budget, so re-runs
+(and other platforms with the same budget) reuse the already-processed images instead of optimizing them again.
+
+Uses Pillow if it's installed. If not, images are passed through unchanged.
+"""
+
+import concurrent.futures
+import hashlib
+import io
+import os
+import time
+
+import atomic_file
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+image_cache_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "image_cache"))
+
+# Processed images older than this many days are cleaned out of the cache.
+cache_max_age_days = 30
+
+# When scaling an image down to fit a byte budget, give up after this many tries.
+max_resize_attempts = 8
+
+
+def _encode_png(img, quantize: bool = False) -> bytes:
+    """Encode a Pillow image as an optimized PNG, optionally quantized to a 256-color palette first."""
+    if quantize and img.mode != "P":
+        # Pillow can only quantize RGB, RGBA and L images. Convert anything else (grayscale+alpha, 16-bit, 1-bit, ...)
+        # first, keeping any transparency.
+        if img.mode not in ("RGB", "RGBA", "L"):
+            has_alpha = img.mode in ("LA", "La", "RGBa", "PA") or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        method = Image.Quantize.FASTOCTREE if img.mode == "RGBA" else Image.Quantize.MEDIANCUT
+        img = img.quantize(colors=256, method=method)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def fit_image_bytes(img_bytes: bytes,
+                    max_bytes: int,
+                    max_dimension: int = None) -> bytes:
+    """Return the smallest-effort PNG encoding of an image that fits within max_bytes and max_dimension.
+
+    Tries, in order: a losslessly-optimized PNG (or the original bytes, if they're within the limits and no bigger), a
+    quantized PNG, and then quantized PNGs at smaller and smaller sizes.
+    """
+    img = Image.open(io.BytesIO(img_bytes))
+    needs_resize = max_dimension is not None and max(img.size) > max_dimension
+    if needs_resize:
+        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+    # Lossless first.
+    out_bytes = _encode_png(img)
+    if not needs_resize and len(img_bytes) <= min(len(out_bytes), max_bytes):
+        return img_bytes
+    if len(out_bytes) <= max_bytes:
+        return out_bytes
+
+    # Then cut it down to a 256-color palette.
+    out_bytes = _encode_png(img, quantize=True)
+
+    # Then scale it down until it fits.
+    attempts = 0
+    while len(out_bytes) > max_bytes and attempts < max_resize_attempts:
+        scale = 0.9 * (max_bytes / len(out_bytes)) ** 0.5
+        img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))),
+                         Image.Resampling.LANCZOS)
+        out_bytes = _encode_png(img, quantize=True)
+        attempts += 1
+
+    if len(out_bytes) > max_bytes:
+        raise ValueError("Could not fit image into {0} bytes (got down to {1}).".format(max_bytes, len(out_bytes)))
+
+    return out_bytes
+
+
+def preprocess_image(img_fn: str,
+                     max_bytes: int,
+                     max_dimension: int = None) -> str:
+    """Fit one image file into a byte and dimension budget. Return the filename of the image to upload."""
+    if Image is None:
+        print("WARNING: Pillow is not installed. Uploading", os.path.basename(img_fn), "as-is.")
+        return img_fn
+
+    with open(img_fn, 'rb') as f:
+        img_bytes = f.read()
+
+    # Processed images are cached by the hash of the original image and the budget they were fit into.
+    cached_fn = os.path.join(image_cache_dir, "{0}_{1}_{2}.png".format(hashlib.sha256(img_bytes).hexdigest(),
+                                                                       max_bytes,
+                                                                       max_dimension))
+    if os.path.exists(cached_fn):
+        # Mark it as recently used, so it doesn't get pruned.
+        os.utime(cached_fn)
+        return cached_fn
+
+    out_bytes = fit_image_bytes(img_bytes, max_bytes, max_dimension)
+    # Cache the result even if it's just the original, so re-runs don't spend time optimizing it again.
+    # Write to a temp file and move it into place, so a parallel run never sees a half-written image.
+    with atomic_file.atomic_write(cached_fn, 'wb') as f:
+        f.write(out_bytes)
+
+    if out_bytes is not img_bytes:
+        print("{0}: {1} --> {2} bytes.".format(os.path.basename(img_fn), len(img_bytes), len(out_bytes)))
+    return cached_fn
+
+
+def preprocess_images(img_fns: list,
+                      max_bytes: int,
+                      max_dimension: int = None) -> list:
+    """Fit a list of image files (some possibly None) into a byte and dimension budget, all in parallel.
+
+    Returns the filenames of the images to upload, in the same order (with None kept as None)."""
+    os.makedirs(image_cache_dir, exist_ok=True)
+    prune_image_cache()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(img_fns))) as executor:
+        futures = [None if img_fn is None else executor.submit(preprocess_image, img_fn, max_bytes, max_dimension)
+                   for img_fn in img_fns]
+
+    return [None if future is None else future.result() for future in futures]
+
+
+def prune_image_cache():
+    """Remove processed images older than cache_max_age_days from the cache."""
+    if not os.path.exists(image_cache_dir):
+        return
+
+    oldest_allowed = time.time() - (cache_max_age_days * 24 * 60 * 60)
+    for fn in os.listdir(image_cache_dir):
+        fpath = os.path.join(image_cache_dir, fn)
+        try:
+            if os.path.getmtime(fpath) < oldest_allowed:
+                os.remove(fpath)
+        except FileNotFoundError:
+            # Another platform's thread may be pruning at the same time.
+            pass
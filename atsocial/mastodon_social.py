@@ -1,14 +1,25 @@
 import argparse
+import mastodon
 from mastodon import Mastodon
 import os
+import re
 
 import anttoday_app_baseclass
+import media_upload_cache
 
 
 class AntTodayAppMastodon(anttoday_app_baseclass.AntTodayAppBaseClass):
 
     def __init__(self):
         super(AntTodayAppMastodon, self).__init__("mastodon")
+        # Mastodon takes images up to 16 MB, and scales down anything larger than about 3840x2160 itself.
+        self.image_max_bytes = 16 * 1024 * 1024
+        self.image_max_dimension = 3840
+        # Media that's never attached to a post gets cleaned up by the server after a day, so only reuse uploads for
+        # a while less than that. (Media that's been attached to a post can't be attached to another one.)
+        self.media_upload_cache = media_upload_cache.MediaUploadCache(self.platform_name, max_age_seconds=12 * 60 * 60)
+        # Mastodon allows 30 media uploads per 30 minutes. With 4 images a post, that's one post every 4 minutes.
+        self.backfill_post_interval_seconds = 4 * 60 + 5
 
     def _login(self):
         # This should already be populated.
@@ -19,6 +30,8 @@ class AntTodayAppMastodon(anttoday_app_baseclass.AntTodayAppBaseClass):
         assert hasattr(creds_obj, "access_token")
         assert hasattr(creds_obj, "api_base_url")
 
+        # Mastodon access tokens don't expire, so there's no login round trip to save here. (Mastodon.py doesn't ask
+        # the instance for its version unless told to, so creating the client costs no requests at all.)
         session = Mastodon(
             client_id=creds_obj.client_id,
             client_secret=creds_obj.client_secret,
@@ -37,91 +50,108 @@ class AntTodayAppMastodon(anttoday_app_baseclass.AntTodayAppBaseClass):
         # print("Welcome to Mastodon,", context.keys, context.keys(), dir(context))
         return session
 
-    def retrieve_post_thread(self,
-                             top_post_id: str,
-                             return_as_postinfo_objects: bool = True) -> list:
-        """Return a list of post attribute data of all self-response replies in a thread to the original post."""
-        # First, get the top post.
-        top_post_id = int(top_post_id)
-        top_post = self.session.status(top_post_id)
-        top_context = self.session.status_context(top_post_id)
-
-        posts_list = [top_post]
-
-        descendants = top_context.descendants
-
-        if len(descendants) == 0:
-            assert hasattr(top_post, "id")
-            if return_as_postinfo_objects:
-                num_images = len(top_post.media_attachments)
-                post_obj = anttoday_app_baseclass.PostInfo(
-                    post_id=top_post.id,
-                    reply_to_id='' if top_post.in_reply_to_id is None else post.in_reply_to_id,
-                    timestamp=top_post.created_at,
-                    text=top_post.content,
-                    img1_path=top_post.media_attachments[0].url if (num_images >= 1) else None,
-                    img1_alt=top_post.media_attachments[0].description if (num_images >= 1) else None,
-                    img2_path=top_post.media_attachments[1].url if (num_images >= 2) else None,
-                    img2_alt=top_post.media_attachments[1].description if (num_images >= 2) else None,
-                    img3_path=top_post.media_attachments[2].url if (num_images >= 3) else None,
-                    img3_alt=top_post.media_attachments[2].description if (num_images >= 3) else None,
-                    img4_path=top_post.media_attachments[3].url if (num_images >= 4) else None,
-                    img4_alt=top_post.media_attachments[3].description if (num_images >= 4) else None,
-                    comments=None,
-                )
-                return [post_obj]
-
-            else:
-                return posts_list
-        else:
-            desc_from_original_user = [desc for desc in descendants if
-                                       (desc.account.username == top_post.account.username) and
-                                       (desc.in_reply_to_account_id == top_post.account.id)]
-            posts_list = posts_list + desc_from_original_user
+    @staticmethod
+    def _status_to_postinfo(post) -> anttoday_app_baseclass.PostInfo:
+        """Convert a Mastodon status into a PostInfo object."""
+        num_images = len(post.media_attachments)
+        return anttoday_app_baseclass.PostInfo(
+            post_id=post.id,
+            reply_to_id='' if post.in_reply_to_id is None else post.in_reply_to_id,
+            timestamp=post.created_at,
+            text=post.content,
+            img1_path=post.media_attachments[0].url if (num_images >= 1) else None,
+            img1_alt=post.media_attachments[0].description if (num_images >= 1) else None,
+            img2_path=post.media_attachments[1].url if (num_images >= 2) else None,
+            img2_alt=post.media_attachments[1].description if (num_images >= 2) else None,
+            img3_path=post.media_attachments[2].url if (num_images >= 3) else None,
+            img3_alt=post.media_attachments[2].description if (num_images >= 3) else None,
+            img4_path=post.media_attachments[3].url if (num_images >= 4) else None,
+            img4_alt=post.media_attachments[3].description if (num_images >= 4) else None,
+            comments=None,
+        )
+
+    @staticmethod
+    def _link_own_replies(start_post, descendants) -> list:
+        """Follow our own linear chain of replies from start_post through a list of its descendants.
+
+        Returns the list of posts in the chain, starting with start_post."""
+        # Only keep posts by us, in reply to us.
+        desc_from_original_user = [desc for desc in descendants if
+                                   (desc.account.username == start_post.account.username) and
+                                   (desc.in_reply_to_account_id == start_post.account.id)]
 
         # Make sure that all these posts were in replies only to myself
-        posts_sorted = sorted(posts_list, key=lambda x: x.id)
+        posts_sorted = sorted(desc_from_original_user, key=lambda x: x.id)
 
         # Run through IN ORDER, and make sure that each one descended from the previous one. Skip any ones that aren't.
-        prev_post = posts_sorted[0]
-        posts_sorted_linear = [posts_sorted[0]]
-        for i in range(1, len(posts_sorted)):
-            this_post = posts_sorted[i]
+        prev_post = start_post
+        posts_sorted_linear = [start_post]
+        for this_post in posts_sorted:
             if (this_post.in_reply_to_id == prev_post.id) and \
                     (this_post.in_reply_to_account_id == prev_post.account.id):
                 posts_sorted_linear.append(this_post)
                 prev_post = this_post
-            else:
-                continue
+
+        return posts_sorted_linear
+
+    def _fetch_sync_anchor(self):
+        """Fetch the last synced post in the thread, to resume the thread from.
+
+        Returns None if there's no anchor, or if it was deleted or no longer matches what we have recorded."""
+        anchor_id, anchor_reply_to_id = self.get_sync_anchor()
+        if anchor_id is None:
+            return None
+
+        try:
+            anchor_post = self.session.status(int(anchor_id))
+        except mastodon.MastodonNotFoundError:
+            anchor_post = None
+
+        # The anchor should be one of our replies to ourselves, to the same parent we have recorded for it.
+        if anchor_post is None or \
+                anchor_post.in_reply_to_account_id != anchor_post.account.id or \
+                (anchor_reply_to_id not in (None, '') and str(anchor_post.in_reply_to_id) != str(anchor_reply_to_id)):
+            print("Last synced {0} post {1} no longer matches the thread online. Re-syncing the whole "
+                  "thread.".format(self.platform_name, anchor_id))
+            return None
+
+        return anchor_post
+
+    def retrieve_post_thread(self,
+                             top_post_id: str,
+                             return_as_postinfo_objects: bool = True) -> list:
+        """Return a list of post attribute data of all self-response replies in a thread to the original post.
+
+        If incremental syncing is on, only the descendants of the last synced post (see get_sync_anchor()) are fetched
+        and linked. The full context of the top post is only fetched if that anchor post is gone or no longer matches
+        what we have recorded. The PostInfo objects returned cover the whole cached run of the thread, while the
+        Mastodon status objects only cover the posts retrieved this session.
+        """
+        start_post = self._fetch_sync_anchor()
+
+        # If there's no usable anchor, start from the top post.
+        if start_post is None:
+            start_post = self.session.status(int(top_post_id))
+
+        # This returns all the descendants of the start post, including other people's replies. If the post has no
+        # replies at all (the usual case for an up-to-date anchor), we can skip asking.
+        if start_post.replies_count == 0:
+            descendants = []
+        else:
+            descendants = self.session.status_context(start_post.id).descendants
+        posts_sorted_linear = self._link_own_replies(start_post, descendants)
 
         # print(len(posts_sorted_linear), "posts in linear thread by '{0}'.".format(posts_sorted_linear[0].account.username))
 
-        if return_as_postinfo_objects:
-            # Turn all the posts into PostInfo objects.
-            postinfo_objects = [None] * len(posts_sorted_linear)
-            for i, post in enumerate(posts_sorted_linear):
-                num_images = len(post.media_attachments)
-                post_obj = anttoday_app_baseclass.PostInfo(
-                    post_id=post.id,
-                    reply_to_id='' if post.in_reply_to_id is None else post.in_reply_to_id,
-                    timestamp=post.created_at,
-                    text=post.content,
-                    img1_path=post.media_attachments[0].url if (num_images >= 1) else None,
-                    img1_alt=post.media_attachments[0].description if (num_images >= 1) else None,
-                    img2_path=post.media_attachments[1].url if (num_images >= 2) else None,
-                    img2_alt=post.media_attachments[1].description if (num_images >= 2) else None,
-                    img3_path=post.media_attachments[2].url if (num_images >= 3) else None,
-                    img3_alt=post.media_attachments[2].description if (num_images >= 3) else None,
-                    img4_path=post.media_attachments[3].url if (num_images >= 4) else None,
-                    img4_alt=post.media_attachments[3].description if (num_images >= 4) else None,
-                    comments=None,
-                )
-                postinfo_objects[i] = post_obj
+        # Keep the on-disk thread cache up to date with whatever we've retrieved.
+        postinfo_objects = self.update_thread_cache(top_post_id,
+                                                    [self._status_to_postinfo(post) for post in posts_sorted_linear])
 
+        if return_as_postinfo_objects:
             return postinfo_objects
 
         else:
-            # Otherwise, just return as the atproto post class objects.
+            # Otherwise, just return as the Mastodon status objects.
             return posts_sorted_linear
 
     def get_post_data(self,
@@ -129,6 +159,25 @@ class AntTodayAppMastodon(anttoday_app_baseclass.AntTodayAppBaseClass):
         """Get the status & details of a post from its ID number."""
         return self.session.status(post_id)
 
+    def _tail_index_entry(self, post) -> dict:
+        """Return a tail index entry for a Mastodon status, with the visibility to reply with."""
+        return {"post_id": post.id,
+                "visibility": post.visibility}
+
+    def _confirm_tail_post(self, tail_entry: dict):
+        """Check, with a single status() call, that the post in the tail index is still there without any replies.
+        Return its status if so, otherwise None."""
+        try:
+            post = self.session.status(int(tail_entry["post_id"]))
+        except mastodon.MastodonNotFoundError:
+            return None
+
+        # If anyone has replied to it (maybe us), let the full lookup sort out which post is the latest.
+        if post.replies_count > 0:
+            return None
+
+        return post
+
     def _create_post(self,
                      text: str,
                      image1: str,
@@ -143,25 +192,53 @@ class AntTodayAppMastodon(anttoday_app_baseclass.AntTodayAppBaseClass):
         """Create a post with the necessary data, fetch the latest reply, a post to the thread.
 
         Return the id of the new post."""
+        # Reply to the latest post in the thread. A tail index entry written moments ago (by our own previous post,
+        # when posting several days in a row) is used as-is. Otherwise find the latest post.
         if reply_to_latest:
-            last_post = self.find_latest_thread_post()
+            tail_entry = self.read_tail_index()
+            if tail_entry is None or not self.is_tail_index_fresh(tail_entry) or "visibility" not in tail_entry:
+                tail_entry = self._tail_index_entry(self.find_latest_thread_post())
+            reply_to_id = int(tail_entry["post_id"])
+            visibility = tail_entry["visibility"]
         else:
-            last_post = None
-
-        # Gather all the images.
-        media_to_include = []
-        for (img_name, img_desc) in zip([image1, image2, image3, image4],
-                                        [image1_alt, image2_alt, image3_alt, image4_alt]):
-            if img_name:
-                assert os.path.exists(img_name)
-                media = self.session.media_post(img_name,
-                                                description=img_desc)
-                media_to_include.append(media)
+            # Not in a thread. Use the account's default visibility.
+            reply_to_id = None
+            visibility = None
+
+        uploaded_keys = []
+
+        def upload_image(img_name, img_desc):
+            assert os.path.exists(img_name)
+            with open(img_name, 'rb') as f:
+                img_key = media_upload_cache.media_key(f.read(), img_desc)
+            uploaded_keys.append(img_key)
+
+            # If we've already uploaded this image with this description (e.g. a post that failed after uploading),
+            # reuse that media rather than sending it again.
+            media_id = self.media_upload_cache.get(img_key)
+            if media_id is None:
+                media_id = self.session.media_post(img_name,
+                                                   description=img_desc).id
+                self.media_upload_cache.put(img_key, media_id)
+
+            return media_id
+
+        # Gather all the images, uploading them all at once. If any of them fail, this raises before we post anything.
+        media_to_include = self.upload_images(list(zip([image1, image2, image3, image4],
+                                                       [image1_alt, image2_alt, image3_alt, image4_alt])),
+                                              upload_image)
 
         new_post = self.session.status_post(text,
-                                            in_reply_to_id=last_post,
+                                            in_reply_to_id=reply_to_id,
                                             media_ids=None if (len(media_to_include) == 0) else media_to_include,
-                                            visibility=last_post.visibility)
+                                            visibility=visibility)
+
+        # Those uploads are attached to this post now, so they can't be reused.
+        self.media_upload_cache.remove(uploaded_keys)
+
+        # The new post is now the tail of the thread.
+        if reply_to_latest:
+            self.update_tail_index(self._tail_index_entry(new_post))
 
         return new_post.id
 
@@ -189,6 +266,9 @@ def define_and_parse_args():
     parser.add_argument("-comment", "-c", type=str, default="",
                         help="Add a comment into the 'comments' field in the last post. These comments are not seen "
                              "with the posts, they are simply for our own benefit.")
+    parser.add_argument("-full_sync", "-f", action="store_true", default=False,
+                        help="Re-fetch the whole thread from the top post, rather than resuming from the last post "
+                             "already synced in the thread cache or post history.")
 
     return parser.parse_args()
 
@@ -202,10 +282,12 @@ if __name__ == "__main__":
             "ERROR: The argument -date must be in a YYYY.MM.DD format, which '{0}' is not. Exiting.".format(args.date))
 
     app = AntTodayAppMastodon()
+    app.incremental_sync = not args.full_sync
 
     app.open_and_populate()
-    df = app.update_thread_data_file(new_date_covered=None if (args.date == "") else args.date,
-                                     new_comment=None if (args.comment == "") else args.comment)
+    app.update_thread_data_file(new_date_covered=None if (args.date == "") else args.date,
+                                new_comment=None if (args.comment == "") else args.comment)
+    df = app.post_history_df
 
     print("Last post info:")
     colnames = list(df.columns)
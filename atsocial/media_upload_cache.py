@@ -0,0 +1,89 @@
+"""A persistent cache of uploaded images on each platform, so retries and re-runs don't upload the same images again.
+
+Entries are keyed by the SHA-256 hash of the image bytes (plus anything else that was sent with the upload, like
+Mastodon's alt-text description), and hold whatever the platform gave back to reference the upload: a blob ref for
+BlueSky, a media id for Mastodon. Each platform deletes uploads that never get attached to a post after a while, so
+entries expire after max_age_seconds, set a bit shorter than the platform's own orphan-media retention.
+
+Each platform gets its own small JSON file in the /data/ directory.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import atomic_file
+
+cache_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+
+
+def media_key(img_bytes: bytes, *extra_fields) -> str:
+    """Return the cache key for an image: the SHA-256 of its bytes, plus a hash of any extra fields sent with it."""
+    key = hashlib.sha256(img_bytes).hexdigest()
+    if len(extra_fields) > 0:
+        key += "_" + hashlib.sha256("\n".join(str(field) for field in extra_fields).encode('utf-8')).hexdigest()[:16]
+    return key
+
+
+class MediaUploadCache:
+    """Read and write the cache of uploaded images for one platform."""
+
+    def __init__(self,
+                 platform_name: str,
+                 max_age_seconds: float,
+                 cache_fname: str = None):
+        self.platform_name = platform_name
+        self.max_age_seconds = max_age_seconds
+        self.cache_fname = os.path.join(cache_dir, "media_upload_cache_{0}.json".format(platform_name)) \
+            if cache_fname is None else cache_fname
+        # Images in a post are uploaded in parallel, so guard the entries with a lock.
+        self.lock = threading.Lock()
+        # Loaded lazily the first time it's needed. A dictionary of {key: {"uploaded": time, "ref": ref}}.
+        self.entries = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        if os.path.exists(self.cache_fname):
+            try:
+                with open(self.cache_fname, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print("WARNING: Could not read media upload cache {0}. Ignoring it.".format(
+                    os.path.basename(self.cache_fname)))
+
+        # Drop anything the platform will have already cleaned up.
+        oldest_allowed = time.time() - self.max_age_seconds
+        self.entries = {key: entry for key, entry in self.entries.items() if entry["uploaded"] >= oldest_allowed}
+
+    def _save(self):
+        with atomic_file.atomic_write(self.cache_fname) as f:
+            json.dump(self.entries, f)
+
+    def get(self, key: str):
+        """Return the platform's reference to a live upload of this image, or None if there isn't one."""
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+            if entry is None or entry["uploaded"] < time.time() - self.max_age_seconds:
+                return None
+            return entry["ref"]
+
+    def put(self, key: str, ref):
+        """Record a new upload of an image. 'ref' must be JSON-serializable."""
+        with self.lock:
+            self._load()
+            self.entries[key] = {"uploaded": time.time(), "ref": ref}
+            self._save()
+
+    def remove(self, keys: list):
+        """Forget some uploads, e.g. once they're attached to a post and can't be attached to another one."""
+        with self.lock:
+            self._load()
+            for key in keys:
+                self.entries.pop(key, None)
+            self._save()
@@ -0,0 +1,68 @@
+"""platform_registry.py - Find and load the backend class for each social media platform in platform_data.csv.
+
+Each platform_name in platform_data.csv maps to the module and class that implement it. A backend's module (and with
+it the platform's SDK, e.g. atproto or Mastodon.py) is only imported if that platform is enabled, so a run that only
+posts on one platform doesn't pay for importing the others. Adding a platform means adding a row to platform_data.csv
+and an entry to platform_backends here.
+
+Created by Mike MacFerrin
+"""
+
+import importlib
+import os
+import time
+
+import config_loader
+
+platform_data_csvname = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "platform_data.csv"))
+
+# The (module name, class name) of the backend for each platform_name in platform_data.csv.
+platform_backends = {"bluesky": ("atproto_social", "AntTodayAppATProto"),
+                     "mastodon": ("mastodon_social", "AntTodayAppMastodon"),
+                     }
+
+
+def is_enabled(enabled_value: str) -> bool:
+    """Read a value from the "enabled" column. Blank (or no column at all) counts as enabled."""
+    enabled_value = (enabled_value or "").strip().lower()
+    return enabled_value in ("", "1", "true", "yes", "y")
+
+
+def read_platform_rows(csvname: str = platform_data_csvname) -> list:
+    """Read platform_data.csv into a list of dictionaries, one per platform, skipping the '#' comment lines."""
+    return config_loader.read_table(csvname)
+
+
+def enabled_platforms(platform_names: list = None,
+                      csvname: str = platform_data_csvname) -> list:
+    """Return the names of the platforms to run, in the order they're listed in platform_data.csv.
+
+    If platform_names is given, use just those platforms regardless of the "enabled" column."""
+    rows = read_platform_rows(csvname)
+    listed_names = [row["platform_name"] for row in rows]
+
+    if platform_names:
+        for platform_name in platform_names:
+            assert platform_name in listed_names, \
+                "Platform '{0}' is not listed in {1}.".format(platform_name, os.path.basename(csvname))
+        return [name for name in listed_names if name in platform_names]
+
+    return [row["platform_name"] for row in rows if is_enabled(row.get("enabled"))]
+
+
+def load_backend(platform_name: str):
+    """Import the backend module for a platform and return its app class. Prints how long the import took."""
+    assert platform_name in platform_backends, "No backend is registered for platform '{0}'.".format(platform_name)
+    module_name, class_name = platform_backends[platform_name]
+
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    print("Loaded {0} backend ({1}) in {2:.2f} s.".format(platform_name, module_name, time.perf_counter() - start))
+
+    return getattr(module, class_name)
+
+
+def create_apps(platform_names: list = None,
+                csvname: str = platform_data_csvname) -> list:
+    """Create an app object for each enabled platform (or just the ones in platform_names)."""
+    return [load_backend(platform_name)() for platform_name in enabled_platforms(platform_names, csvname)]
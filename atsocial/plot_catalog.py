@@ -0,0 +1,178 @@
+"""plot_catalog.py - A persistent catalog of the Antarctica Today "daily_plots_gathered" directory.
+
+Maps each YYYY.MM.DD date folder to its four images (daily melt map, sum map, anomaly map and line plot), with each
+image's path, size and SHA-256 hash. The catalog is kept in a JSON manifest in the /data/ directory and updated
+incrementally: the list of date folders is only re-read when the gathered directory's modification time changes, and a
+day's images are only looked up again (and re-hashed) when that day's folder or images change. So "the latest date"
+and "the images for date X" are lookups rather than directory scans, however many seasons of folders pile up.
+
+Created by Mike MacFerrin
+"""
+
+import json
+import os
+import re
+import threading
+
+import atomic_file
+import file_staging
+
+# Bump this whenever the format of the catalog file changes. Catalogs with a different version are rebuilt.
+CATALOG_VERSION = 1
+
+catalog_fname_default = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "plot_catalog.json"))
+
+date_dir_regex = re.compile(r"\A\d{4}\.\d{2}\.\d{2}\Z")
+
+# The images in each day's folder, in the order they're posted, with the patterns that identify them.
+# "{date}" is filled in with the folder's YYYY.MM.DD date.
+image_roles = ["daily_melt_map", "sum_map", "anomaly_map", "line_plot"]
+image_patterns = {"daily_melt_map": r"R0_{date}_daily\.",
+                  "sum_map": r"R0_\d{{4}}-\d{{4}}_{date}_sum\.",
+                  "anomaly_map": r"R0_\d{{4}}-\d{{4}}_{date}_anomaly\.",
+                  "line_plot": r"R0_\d{{4}}-\d{{4}}_{date}_gap_filled\."}
+
+
+def find_day_images(dirname: str, filetype: str = "png") -> dict:
+    """Scan one day's folder for its four images. Returns {role: image path (or None if it's missing)}."""
+    date_subdir = os.path.split(dirname)[1]
+    subfiles = [fn for fn in os.listdir(dirname) if
+                (os.path.splitext(fn)[-1].lower().lstrip(".") == filetype.lower().lstrip("."))]
+
+    images = {}
+    for role in image_roles:
+        role_regex = re.compile(image_patterns[role].format(date=re.escape(date_subdir)))
+        matches = [fn for fn in subfiles if role_regex.search(fn) is not None]
+        images[role] = os.path.join(dirname, matches[0]) if len(matches) > 0 else None
+
+    return images
+
+
+class PlotCatalog:
+    """The catalog of dated image folders in one gathered-plots directory."""
+
+    def __init__(self,
+                 gathered_dir: str,
+                 filetype: str = "png",
+                 catalog_fname: str = catalog_fname_default):
+        self.gathered_dir = os.path.abspath(gathered_dir)
+        self.filetype = filetype
+        self.catalog_fname = catalog_fname
+        self.lock = threading.Lock()
+        # Loaded lazily the first time it's needed.
+        self.catalog = None
+
+    def _load(self):
+        if self.catalog is not None:
+            return
+
+        self.catalog = None
+        if os.path.exists(self.catalog_fname):
+            try:
+                with open(self.catalog_fname, 'r') as f:
+                    catalog = json.load(f)
+                if catalog.get("version") == CATALOG_VERSION \
+                        and catalog.get("gathered_dir") == self.gathered_dir \
+                        and catalog.get("filetype") == self.filetype:
+                    self.catalog = catalog
+            except ValueError:
+                print("WARNING: Could not read plot catalog {0}. Rebuilding it.".format(
+                    os.path.basename(self.catalog_fname)))
+
+        if self.catalog is None:
+            self.catalog = {"version": CATALOG_VERSION,
+                            "gathered_dir": self.gathered_dir,
+                            "filetype": self.filetype,
+                            "dir_mtime_ns": None,
+                            "dates": {}}
+
+    def _save(self):
+        with atomic_file.atomic_write(self.catalog_fname) as f:
+            json.dump(self.catalog, f)
+
+    def _refresh_dates(self) -> bool:
+        """Re-read the list of date folders if the gathered directory has changed. Returns True if anything changed."""
+        dir_mtime_ns = os.stat(self.gathered_dir).st_mtime_ns
+        if dir_mtime_ns == self.catalog["dir_mtime_ns"]:
+            return False
+
+        current_dates = set(dn for dn in os.listdir(self.gathered_dir)
+                            if date_dir_regex.search(dn) is not None
+                            and os.path.isdir(os.path.join(self.gathered_dir, dn)))
+
+        cataloged = self.catalog["dates"]
+        for datestr in list(cataloged.keys()):
+            if datestr not in current_dates:
+                del cataloged[datestr]
+        for datestr in current_dates:
+            if datestr not in cataloged:
+                # Found the date. Its images are only looked up when they're asked for.
+                cataloged[datestr] = None
+
+        self.catalog["dir_mtime_ns"] = dir_mtime_ns
+        return True
+
+    def _day_entry_is_current(self, entry: dict, day_dir: str) -> bool:
+        if entry is None or entry["dir_mtime_ns"] != os.stat(day_dir).st_mtime_ns:
+            return False
+
+        for image_info in entry["images"].values():
+            if image_info is None:
+                continue
+            try:
+                stat = os.stat(image_info["path"])
+            except FileNotFoundError:
+                return False
+            if stat.st_size != image_info["size"] or stat.st_mtime_ns != image_info["mtime_ns"]:
+                return False
+
+        return True
+
+    def _catalog_day(self, datestr: str) -> dict:
+        day_dir = os.path.join(self.gathered_dir, datestr)
+        entry = {"dir_mtime_ns": os.stat(day_dir).st_mtime_ns,
+                 "images": {}}
+
+        for role, image_path in find_day_images(day_dir, self.filetype).items():
+            if image_path is None:
+                entry["images"][role] = None
+                continue
+            stat = os.stat(image_path)
+            entry["images"][role] = {"path": image_path,
+                                     "size": stat.st_size,
+                                     "mtime_ns": stat.st_mtime_ns,
+                                     "sha256": file_staging.sha256_file(image_path)}
+
+        return entry
+
+    def dates(self) -> list:
+        """Return the sorted list of YYYY.MM.DD dates that have a folder in the gathered-plots directory."""
+        with self.lock:
+            self._load()
+            if self._refresh_dates():
+                self._save()
+            return sorted(self.catalog["dates"].keys())
+
+    def latest_date(self) -> str:
+        """Return the latest date with a folder, or None if there aren't any."""
+        dates = self.dates()
+        return dates[-1] if len(dates) > 0 else None
+
+    def day_images(self, datestr: str) -> dict:
+        """Return {role: {"path", "size", "mtime_ns", "sha256"}} for a day's four images (None for any missing).
+
+        Raises KeyError if there's no folder for that date."""
+        with self.lock:
+            self._load()
+            changed = self._refresh_dates()
+
+            entry = self.catalog["dates"][datestr]
+            if not self._day_entry_is_current(entry, os.path.join(self.gathered_dir, datestr)):
+                entry = self._catalog_day(datestr)
+                self.catalog["dates"][datestr] = entry
+                changed = True
+
+            if changed:
+                self._save()
+
+            return entry["images"]
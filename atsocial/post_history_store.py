@@ -0,0 +1,341 @@
+"""Storage backends for the post history of each platform, as an alternative to rewriting the post_history CSV.
+
+SQLitePostHistoryStore keeps the post history in a local SQLite database, indexed on post_id and date_covered.
+Reads like "last date covered" and "tail post" are index lookups, and writes are single transactions of just the rows
+that changed. It imports from and exports to the same CSV format as the post_history_*.csv files.
+
+JournaledPostHistoryStore keeps the post_history CSV as a snapshot, and appends changed rows to a journal file next to
+it (fsync'ed on every write). Every so often the journal is compacted into a new snapshot, keeping a few gzipped
+backups of the previous snapshots.
+
+Both stores have the same methods, so the app classes can use either one.
+
+Created by Mike MacFerrin
+"""
+
+import argparse
+import csv
+import datetime
+import glob
+import gzip
+import io
+import json
+import os
+import shutil
+import sqlite3
+
+import atomic_file
+
+# The columns of a post history table, in the order they're stored. The CSV files may put them in a different order.
+post_history_columns = ["post_id",
+                        "reply_to_id",
+                        "timestamp",
+                        "date_covered",
+                        "text",
+                        "img1",
+                        "img1_alt",
+                        "img2",
+                        "img2_alt",
+                        "img3",
+                        "img3_alt",
+                        "img4",
+                        "img4_alt",
+                        "comments"]
+
+
+def _to_text(val) -> str:
+    """All values are stored as text, with empty strings for missing values (same as in the CSV files)."""
+    if val is None or (type(val) is float and val != val):
+        return ''
+    return str(val)
+
+
+def _read_csv_rows(csv_fname: str):
+    """Read a post history CSV (skipping "#" comment lines). Return (column names, list of row dictionaries)."""
+    with open(csv_fname, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(line for line in f if not line.startswith("#"))
+        rows = list(reader)
+        columns = reader.fieldnames
+
+    assert columns is not None and set(columns).issubset(post_history_columns)
+    return columns, rows
+
+
+class SQLitePostHistoryStore:
+    """A post history kept in a local SQLite database."""
+
+    def __init__(self, db_fname: str):
+        self.store_fname = db_fname
+        # Each app has its own store, but it may be opened and used from different threads when posting concurrently.
+        self.conn = sqlite3.connect(db_fname, check_same_thread=False)
+        self._create_tables()
+
+    def _create_tables(self):
+        # "seq" keeps the rows in thread order, the same order they were in the CSV.
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS posts "
+                              "(seq INTEGER PRIMARY KEY AUTOINCREMENT, " +
+                              ", ".join("{0} TEXT NOT NULL DEFAULT ''".format(col) for col in post_history_columns) +
+                              ")")
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS posts_post_id ON posts (post_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS posts_date_covered ON posts (date_covered)")
+            # The column order to use when exporting back out to CSV.
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def close(self):
+        self.conn.close()
+
+    def is_empty(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM posts LIMIT 1").fetchone() is None
+
+    def csv_columns(self) -> list:
+        """The column order of the CSV file this store was imported from."""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'csv_columns'").fetchone()
+        return post_history_columns if row is None else row[0].split(",")
+
+    def upsert_rows(self, rows: list):
+        """Insert or update a list of rows (dictionaries of column values, keyed by post_id), in a single transaction.
+
+        New rows are added to the end of the thread. Columns missing from a row are left as they are."""
+        with self.conn:
+            for row in rows:
+                cols = [col for col in post_history_columns if col in row]
+                assert "post_id" in cols
+                self.conn.execute("INSERT INTO posts ({0}) VALUES ({1}) "
+                                  "ON CONFLICT (post_id) DO UPDATE SET {2}".format(
+                                      ", ".join(cols),
+                                      ", ".join("?" * len(cols)),
+                                      ", ".join("{0} = excluded.{0}".format(col) for col in cols if col != "post_id")
+                                      or "post_id = excluded.post_id"),
+                                  [_to_text(row[col]) for col in cols])
+
+    def read_rows(self) -> list:
+        """Return all the rows, in thread order, as dictionaries of column values."""
+        cursor = self.conn.execute("SELECT {0} FROM posts ORDER BY seq".format(", ".join(post_history_columns)))
+        return [dict(zip(post_history_columns, row)) for row in cursor]
+
+    def first_post_id(self):
+        row = self.conn.execute("SELECT post_id FROM posts ORDER BY seq LIMIT 1").fetchone()
+        return None if row is None else row[0]
+
+    def tail_post_id(self):
+        row = self.conn.execute("SELECT post_id FROM posts ORDER BY seq DESC LIMIT 1").fetchone()
+        return None if row is None else row[0]
+
+    def last_synced_post(self):
+        """Return the (post_id, reply_to_id) of the last post that's been filled in from online, or (None, None)."""
+        row = self.conn.execute("SELECT post_id, reply_to_id FROM posts WHERE timestamp != '' "
+                                "ORDER BY seq DESC LIMIT 1").fetchone()
+        return (None, None) if row is None else row
+
+    def last_date_covered(self) -> str:
+        row = self.conn.execute("SELECT MAX(date_covered) FROM posts").fetchone()
+        return '' if row[0] is None else row[0]
+
+    def import_csv(self, csv_fname: str):
+        """Read a post history CSV into the store, updating any rows already in here."""
+        columns, rows = _read_csv_rows(csv_fname)
+        self.upsert_rows(rows)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_columns', ?)",
+                              [",".join(columns)])
+
+    def export_csv_text(self) -> str:
+        """Return the whole post history as the text of a post history CSV."""
+        columns = self.csv_columns()
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(self.read_rows())
+        return buffer.getvalue()
+
+    def export_csv(self, csv_fname: str):
+        """Write the whole post history out to a post history CSV."""
+        with open(csv_fname, 'w', newline='', encoding='utf-8') as f:
+            f.write(self.export_csv_text())
+
+
+class JournaledPostHistoryStore:
+    """A post history kept as a CSV snapshot plus an append-only journal of changed rows."""
+
+    def __init__(self,
+                 csv_fname: str,
+                 compact_every: int = 100,
+                 max_backups: int = 5):
+        self.store_fname = csv_fname
+        base, ext = os.path.splitext(csv_fname)
+        self.journal_fname = base + ".journal"
+        self.backup_fname_pattern = base + "_backup_{0}" + ext + ".gz"
+        # Fold the journal into a new snapshot once it has this many records in it.
+        self.compact_every = compact_every
+        # How many gzipped backups of old snapshots to keep around.
+        self.max_backups = max_backups
+
+        self.columns, snapshot_rows = _read_csv_rows(csv_fname)
+        # The rows, in thread order, keyed by post_id. (Dictionaries keep their insertion order.)
+        self.rows = {row["post_id"]: {col: _to_text(row.get(col)) for col in post_history_columns}
+                     for row in snapshot_rows}
+        self.num_journal_records = self._replay_journal()
+
+    def _apply(self, row: dict):
+        post_id = _to_text(row["post_id"])
+        existing_row = self.rows.setdefault(post_id, {col: '' for col in post_history_columns})
+        existing_row.update({col: _to_text(row[col]) for col in post_history_columns if col in row})
+        existing_row["post_id"] = post_id
+
+    def _replay_journal(self) -> int:
+        """Apply the journal records on top of the snapshot. Return the number of records applied."""
+        if not os.path.exists(self.journal_fname):
+            return 0
+
+        num_records = 0
+        # The byte offset of the end of the last complete record.
+        good_offset = 0
+        with open(self.journal_fname, 'rb') as f:
+            for line in f:
+                try:
+                    # Every complete record ends with a newline.
+                    assert line.endswith(b"\n")
+                    record = json.loads(line)
+                except (AssertionError, ValueError):
+                    break
+                self._apply(record)
+                num_records += 1
+                good_offset += len(line)
+
+            journal_size = f.seek(0, os.SEEK_END)
+
+        # Only the last record can be incomplete, if we crashed in the middle of writing it. Cut it off so that new
+        # records don't get appended onto the end of it.
+        if good_offset < journal_size:
+            print("WARNING: Dropping an incomplete record at the end of", os.path.basename(self.journal_fname))
+            with open(self.journal_fname, 'r+b') as f:
+                f.truncate(good_offset)
+
+        return num_records
+
+    def close(self):
+        pass
+
+    def is_empty(self) -> bool:
+        return len(self.rows) == 0
+
+    def csv_columns(self) -> list:
+        return self.columns
+
+    def upsert_rows(self, rows: list):
+        """Append a list of rows (dictionaries of column values, keyed by post_id) to the journal, and sync it to disk.
+
+        New rows are added to the end of the thread. Columns missing from a row are left as they are."""
+        if len(rows) == 0:
+            return
+
+        records = [{col: _to_text(row[col]) for col in post_history_columns if col in row} for row in rows]
+        with open(self.journal_fname, 'a', encoding='utf-8') as f:
+            for record in records:
+                assert "post_id" in record
+                f.write(json.dumps(record, separators=(',', ':')) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        for record in records:
+            self._apply(record)
+        self.num_journal_records += len(records)
+
+        if self.num_journal_records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Fold the journal into a new CSV snapshot, back up the old snapshot, and start a fresh journal."""
+        # Keep a compressed backup of the old snapshot, and drop the oldest backups.
+        backup_fname = self.backup_fname_pattern.format(datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f"))
+        with open(self.store_fname, 'rb') as f_in, gzip.open(backup_fname, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        for old_backup_fname in sorted(glob.glob(self.backup_fname_pattern.format("*")))[:-self.max_backups]:
+            os.remove(old_backup_fname)
+
+        # Write the new snapshot to a temp file first, and only move it into place once it's fully on disk.
+        with atomic_file.atomic_write(self.store_fname, 'w', newline='', encoding='utf-8') as f:
+            f.write(self.export_csv_text())
+            f.flush()
+            os.fsync(f.fileno())
+        # If we crash before this, the journal just gets re-applied to the new snapshot, which changes nothing.
+        open(self.journal_fname, 'w').close()
+        self.num_journal_records = 0
+
+        print(os.path.basename(self.store_fname), "compacted with {0} entries.".format(len(self.rows)))
+
+    def read_rows(self) -> list:
+        """Return all the rows, in thread order, as dictionaries of column values."""
+        return [dict(row) for row in self.rows.values()]
+
+    def first_post_id(self):
+        return next(iter(self.rows), None)
+
+    def tail_post_id(self):
+        return next(reversed(self.rows), None)
+
+    def last_synced_post(self):
+        """Return the (post_id, reply_to_id) of the last post that's been filled in from online, or (None, None)."""
+        for row in reversed(self.rows.values()):
+            if row["timestamp"] != '':
+                return row["post_id"], row["reply_to_id"]
+        return None, None
+
+    def last_date_covered(self) -> str:
+        return max([row["date_covered"] for row in self.rows.values()], default='')
+
+    def import_csv(self, csv_fname: str):
+        """Read a post history CSV into the store, updating any rows already in here."""
+        columns, rows = _read_csv_rows(csv_fname)
+        self.upsert_rows(rows)
+
+    def export_csv_text(self) -> str:
+        """Return the whole post history as the text of a post history CSV."""
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=self.columns, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(self.rows.values())
+        return buffer.getvalue()
+
+    def export_csv(self, csv_fname: str):
+        """Write the whole post history out to a post history CSV."""
+        with open(csv_fname, 'w', newline='', encoding='utf-8') as f:
+            f.write(self.export_csv_text())
+
+
+def define_and_parse_args():
+    parser = argparse.ArgumentParser(description="Import, export, or compact a post history store. Files ending in "
+                                                 "'.sqlite' are opened as a SQLite store, anything else as the CSV "
+                                                 "snapshot of a journaled store.")
+    parser.add_argument("store_file", type=str, help="The SQLite database, or post history CSV of a journaled store.")
+    parser.add_argument("-import_csv", "-i", type=str, default="",
+                        help="A post history CSV file to import into the store.")
+    parser.add_argument("-export_csv", "-e", type=str, default="",
+                        help="A post history CSV file to export the store out to.")
+    parser.add_argument("-compact", action="store_true", default=False,
+                        help="Fold the journal of a journaled store into its CSV snapshot.")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = define_and_parse_args()
+    if os.path.splitext(args.store_file)[1] == ".sqlite":
+        store = SQLitePostHistoryStore(args.store_file)
+    else:
+        store = JournaledPostHistoryStore(args.store_file)
+
+    if args.import_csv != "":
+        store.import_csv(args.import_csv)
+        print(os.path.basename(args.import_csv), "imported into", os.path.basename(args.store_file))
+
+    if args.export_csv != "":
+        store.export_csv(args.export_csv)
+        print(os.path.basename(args.store_file), "exported to", os.path.basename(args.export_csv))
+
+    if args.compact:
+        assert isinstance(store, JournaledPostHistoryStore)
+        store.compact()
+
+    store.close()
@@ -0,0 +1,48 @@
+"""Save and load each platform's login session, so runs can reuse it instead of logging in from scratch every time.
+
+Sessions are kept in small JSON files in the /credentials/ directory (which is never committed to git), readable
+only by the current user. Each platform decides what goes in its session (e.g. a BlueSky session string). If a saved
+session is missing, unreadable or rejected, the platform just logs in normally and saves a new one.
+"""
+
+import json
+import os
+
+import atomic_file
+
+session_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "credentials"))
+
+
+def session_fname(platform_name: str) -> str:
+    return os.path.join(session_dir, "{0}_session.json".format(platform_name))
+
+
+def load_session(platform_name: str):
+    """Return the saved session dictionary for a platform, or None if there isn't a usable one."""
+    fname = session_fname(platform_name)
+    if not os.path.exists(fname):
+        return None
+
+    try:
+        with open(fname, 'r') as f:
+            session_data = json.load(f)
+    except (OSError, ValueError):
+        print("WARNING: Could not read saved session {0}. Ignoring it.".format(os.path.basename(fname)))
+        return None
+
+    return session_data if isinstance(session_data, dict) else None
+
+
+def save_session(platform_name: str, session_data: dict):
+    """Save a platform's session dictionary, readable only by the current user."""
+    fname = session_fname(platform_name)
+    # atomic_write creates the file as 0o600, so the tokens are never readable by anyone else, even briefly.
+    with atomic_file.atomic_write(fname) as f:
+        json.dump(session_data, f)
+
+
+def delete_session(platform_name: str):
+    """Forget a platform's saved session, e.g. after the server rejects it."""
+    fname = session_fname(platform_name)
+    if os.path.exists(fname):
+        os.remove(fname)
@@ -0,0 +1,120 @@
+"""A persistent, on-disk cache of the posts retrieved from each platform's thread, shared across runs.
+
+Each platform gets its own gzipped JSON file in the /data/ directory. Entries are keyed by platform and top post ID,
+and hold a contiguous run of posts along the thread (usually from the top post to the latest post). Posts go in and
+come out as dictionaries of PostInfo fields (see PostInfo.__dict__ and PostInfo.from_dict()).
+
+Created by Mike MacFerrin
+"""
+
+import gzip
+import json
+import os
+
+import atomic_file
+
+# Bump this whenever the format of the cache files changes. Cache files with a different version are ignored.
+CACHE_VERSION = 1
+
+cache_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+
+# The order of the PostInfo fields stored in each row of the cache.
+postinfo_fields = ["post_id",
+                   "reply_to_id",
+                   "date_covered",
+                   "timestamp",
+                   "text",
+                   "img1",
+                   "img1_alt",
+                   "img2",
+                   "img2_alt",
+                   "img3",
+                   "img3_alt",
+                   "img4",
+                   "img4_alt",
+                   "comments"]
+
+
+class ThreadCache:
+    """Read and write the cached thread posts for one platform."""
+
+    def __init__(self, platform_name, cache_fname=None):
+        self.platform_name = platform_name
+        self.cache_fname = os.path.join(cache_dir, "thread_cache_{0}.json.gz".format(platform_name)) \
+            if cache_fname is None else cache_fname
+        # Loaded lazily the first time it's needed. A dictionary of {key: list of rows}.
+        self.entries = None
+
+    def key(self, top_post_id) -> str:
+        return "{0}:{1}".format(self.platform_name, top_post_id)
+
+    def _load(self):
+        """Read the cache file, if it's there. Ignore it if it's unreadable or from a different cache version."""
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        if not os.path.exists(self.cache_fname):
+            return
+
+        try:
+            with gzip.open(self.cache_fname, 'rt', encoding='utf-8') as f:
+                cache_data = json.load(f)
+        except (OSError, ValueError):
+            print("WARNING: Could not read thread cache {0}. Ignoring it.".format(os.path.basename(self.cache_fname)))
+            return
+
+        if cache_data.get("version") != CACHE_VERSION or cache_data.get("fields") != postinfo_fields:
+            return
+
+        self.entries = cache_data["threads"]
+
+    def _save(self):
+        """Write the cache file out atomically, so a crash never leaves a half-written cache behind."""
+        cache_data = {"version": CACHE_VERSION,
+                      "fields": postinfo_fields,
+                      "threads": self.entries}
+
+        with atomic_file.atomic_write(self.cache_fname, 'wb') as f_raw, gzip.GzipFile(fileobj=f_raw, mode='wb') as f:
+            f.write(json.dumps(cache_data, separators=(',', ':')).encode('utf-8'))
+
+    @staticmethod
+    def _post_to_row(post_dict) -> list:
+        row = [post_dict.get(field) for field in postinfo_fields]
+        # Timestamps come back as datetime objects from some platforms. Store them as strings, the same as in the CSV.
+        return [val if (val is None or type(val) in (str, int, float)) else str(val) for val in row]
+
+    @staticmethod
+    def _row_to_post(row) -> dict:
+        return dict(zip(postinfo_fields, row))
+
+    def get_tail(self, top_post_id):
+        """Return the (post_id, reply_to_id) of the last cached post in this thread, or (None, None)."""
+        self._load()
+        rows = self.entries.get(self.key(top_post_id))
+        if not rows:
+            return None, None
+        return rows[-1][0], rows[-1][1]
+
+    def merge_posts(self, top_post_id, new_posts: list) -> list:
+        """Merge a run of newly-retrieved posts (as dictionaries) into the cached thread, and write it out if it changed.
+
+        If the first new post is already in the cache, the new posts replace everything from that post onward.
+        Otherwise they replace the cached thread entirely. Returns the merged list of post dictionaries.
+        """
+        self._load()
+        key = self.key(top_post_id)
+        cached_rows = self.entries.get(key, [])
+        new_rows = [self._post_to_row(post_dict) for post_dict in new_posts]
+
+        cached_ids = [row[0] for row in cached_rows]
+        if len(new_rows) > 0 and new_rows[0][0] in cached_ids:
+            merged_rows = cached_rows[:cached_ids.index(new_rows[0][0])] + new_rows
+        else:
+            merged_rows = new_rows
+
+        if merged_rows != cached_rows:
+            self.entries[key] = merged_rows
+            self._save()
+
+        return [self._row_to_post(row) for row in merged_rows]
@@ -9,6 +9,8 @@ import os
 import re
 import subprocess
 
+import plot_catalog
+
 # Update this line with the location of the python executable in which you run Antarctica Today.
 at_python_exec = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                               "..", "..", "..",
@@ -28,6 +30,23 @@ pythonpath_env_variable = {
 at_gathered_plots_dir = os.path.abspath(
     os.path.join(pythonpath_env_variable["PYTHONPATH"], "plots", "daily_plots_gathered"))
 
+# The catalog of the dated folders and images in at_gathered_plots_dir (see plot_catalog.py). Created when first needed.
+_plot_catalog = None
+
+
+def get_plot_catalog() -> plot_catalog.PlotCatalog:
+    global _plot_catalog
+    if _plot_catalog is None:
+        _plot_catalog = plot_catalog.PlotCatalog(at_gathered_plots_dir)
+    return _plot_catalog
+
+
+def gathered_plot_dates() -> list:
+    """Return the sorted list of YYYY.MM.DD dates that have a folder of gathered daily plots."""
+    # Each must be a sub-directory in that folder and follow the YYYY.MM.DD naming convention. The catalog only
+    # re-reads the directory if it's changed since last time.
+    return get_plot_catalog().dates()
+
 
 def run_update_data(run_only_if_before_yesterday: bool = True,
                     skip_update_and_just_get_object: bool = False,
@@ -41,10 +60,7 @@ def run_update_data(run_only_if_before_yesterday: bool = True,
     """
 
     # First, get the latest dated folder in the "daily_plots_gathered" directory.
-    # It must be a sub-directory in that folder and follow the YYYY.MM.DD naming convention.
-    dirnames = sorted([dn for dn in os.listdir(at_gathered_plots_dir)
-                       if os.path.isdir(os.path.join(at_gathered_plots_dir, dn))
-                       and re.search(r"\A\d{4}\.\d{2}\.\d{2}\Z", dn) is not None])
+    dirnames = gathered_plot_dates()
     last_dirname = dirnames[-1]
 
     # Check to see whether the latest date is yesterday's date. If so (and we've chosen the default option of
@@ -66,9 +82,7 @@ def run_update_data(run_only_if_before_yesterday: bool = True,
                        env=pythonpath_env_variable)
 
     # Now go get the directory names again. There should be a new one in there with a later date than the others.
-    dirnames = sorted([dn for dn in os.listdir(at_gathered_plots_dir)
-                       if os.path.isdir(os.path.join(at_gathered_plots_dir, dn))
-                       and re.search(r"\A\d{4}\.\d{2}\.\d{2}\Z", dn) is not None])
+    dirnames = gathered_plot_dates()
 
     new_last_dirname = dirnames[-1]
 
@@ -85,29 +99,35 @@ def get_atimages_object_from_dirname(dirname,
     :param dirname: Directory name of the gathered antarctica_today images for that day.
     :param filetype: The extension of the image types to look for.
     """
-    subfiles = [fn for fn in os.listdir(dirname) if
-                (os.path.splitext(fn)[-1].lower().lstrip(".") == filetype.lower().lstrip("."))]
-
     date_subdir = os.path.split(dirname)[1]
 
-    daily_melt_map = os.path.join(dirname,
-                                  [fn for fn in subfiles if
-                                   re.search(r"R0_" + date_subdir + r"_daily\.", fn) is not None][0])
-    sum_map = os.path.join(dirname,
-                           [fn for fn in subfiles if
-                            re.search(r"R0_\d{4}-\d{4}_" + date_subdir + r"_sum\.", fn) is not None][0])
-    anomaly_map = os.path.join(dirname,
-                               [fn for fn in subfiles if
-                                re.search(r"R0_\d{4}-\d{4}_" + date_subdir + r"_anomaly\.", fn) is not None][0])
-    line_plot = os.path.join(dirname,
-                             [fn for fn in subfiles if
-                              re.search(r"R0_\d{4}-\d{4}_" + date_subdir + r"_gap_filled\.", fn) is not None][0])
+    # Days in the gathered-plots directory are looked up in the catalog (which also has their content hashes).
+    # Anywhere else, just scan the folder.
+    image_hashes = {}
+    if os.path.abspath(os.path.dirname(dirname)) == at_gathered_plots_dir and filetype.lower().lstrip(".") == "png":
+        images = {}
+        for (role, image_info) in get_plot_catalog().day_images(date_subdir).items():
+            images[role] = None if image_info is None else image_info["path"]
+            if image_info is not None:
+                image_hashes[role] = image_info["sha256"]
+    else:
+        images = plot_catalog.find_day_images(dirname, filetype)
+
+    missing_roles = [role for role in plot_catalog.image_roles if images[role] is None]
+    if len(missing_roles) > 0:
+        raise FileNotFoundError("No {0} image(s) for {1} in {2}".format(", ".join(missing_roles), date_subdir, dirname))
+
+    daily_melt_map = images["daily_melt_map"]
+    sum_map = images["sum_map"]
+    anomaly_map = images["anomaly_map"]
+    line_plot = images["line_plot"]
 
     return AntarcticaTodayImages(dirname,
                                  daily_melt_map,
                                  sum_map,
                                  anomaly_map,
-                                 line_plot)
+                                 line_plot,
+                                 image_hashes=image_hashes)
 
 
 class AntarcticaTodayImages:
@@ -118,7 +138,8 @@ class AntarcticaTodayImages:
                  daily_melt_map,
                  sum_map,
                  anomaly_map,
-                 line_plot):
+                 line_plot,
+                 image_hashes: dict = None):
         self.dirname = dirname
         self.datestr = os.path.split(dirname)[1]
         # Make sure the directory name is in the YYYY.MM.DD format. It should be unless the directory structure in
@@ -128,6 +149,8 @@ class AntarcticaTodayImages:
         self.sum_map = sum_map
         self.anomaly_map = anomaly_map
         self.line_plot = line_plot
+        # {role: SHA-256 hash} of the images, for any that are already known. Roles are as in plot_catalog.image_roles.
+        self.image_hashes = {} if image_hashes is None else image_hashes
 
 
 if __name__ == "__main__":